@@ -0,0 +1,185 @@
+import os
+import random
+import threading
+import time
+
+import grpc
+from clarifai_grpc.channel import clarifai_channel
+from clarifai_grpc.grpc.api import service_pb2
+from clarifai_grpc.grpc.api.status import status_code_pb2
+from google.protobuf import message_factory
+
+# Keep idle HTTP/2 connections warm between button clicks instead of re-handshaking.
+# gRPC servers accept a ping at most every 5 minutes by default and answer more frequent
+# ones with GOAWAY too_many_pings, which closes the connection this is meant to keep
+KEEPALIVE_OPTIONS = [
+    ("grpc.keepalive_time_ms", 300_000),
+    ("grpc.keepalive_timeout_ms", 10_000),
+    ("grpc.keepalive_permit_without_calls", 1),
+]
+
+
+def make_channel(base=None, insecure=False):
+    # Same options as ClarifaiChannel.get_grpc_channel, plus keepalive
+    if not base:
+        base = os.environ.get("CLARIFAI_GRPC_BASE", "api.clarifai.com")
+    options = [
+        ("grpc.service_config", clarifai_channel.grpc_json_config),
+        ("grpc.max_receive_message_length", clarifai_channel.MAX_MESSAGE_LENGTH),
+        ("grpc.max_send_message_length", clarifai_channel.MAX_MESSAGE_LENGTH),
+    ] + KEEPALIVE_OPTIONS
+    if insecure:
+        return grpc.insecure_channel(base, options=options)
+    return grpc.secure_channel(base, grpc.ssl_channel_credentials(), options=options)
+
+
+class V2Stub:
+    """The ``V2`` service's unary methods on ``channel``, built from the service descriptor.
+
+    ``service_pb2_grpc.V2Stub`` picks its response deserializer from a module
+    global that only ClarifaiChannel's own channel factories set, and those
+    take no channel options, so there would be no keepalive. Methods are
+    created on first use and then kept.
+    """
+
+    SERVICE = service_pb2.DESCRIPTOR.services_by_name["V2"]
+
+    def __init__(self, channel):
+        self._channel = channel
+
+    def __getattr__(self, name):
+        method = self.SERVICE.methods_by_name.get(name)
+        if method is None:
+            raise AttributeError(name)
+        callable_ = self._channel.unary_unary(
+            f"/{self.SERVICE.full_name}/{name}",
+            request_serializer=message_factory.GetMessageClass(method.input_type).SerializeToString,
+            response_deserializer=message_factory.GetMessageClass(method.output_type).FromString,
+        )
+        setattr(self, name, callable_)
+        return callable_
+
+
+class CancelToken:
+    """Lets another thread cancel a ``ClarifaiClient.call``, including the RPC in flight."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._future = None
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            self._event.set()
+            if self._future is not None:
+                self._future.cancel()
+
+    def attach(self, future):
+        with self._lock:
+            self._future = future
+            if self._event.is_set():
+                future.cancel()
+
+    def wait(self, seconds):
+        # Sleeps like time.sleep but wakes up early on cancel; True if cancelled
+        return self._event.wait(seconds)
+
+
+class ClarifaiClient:
+    """One gRPC channel and V2 stub shared by every session in the process.
+
+    gRPC channels are thread-safe and multiplex concurrent calls over one
+    HTTP/2 connection, so there is no reason to open a channel per click.
+    ``call`` adds a per-attempt deadline and retries transient failures, both
+    gRPC errors and Clarifai status codes, with jittered exponential backoff.
+    A timed-out request may still have run on the server, so timeouts are only
+    retried for calls marked ``idempotent``.
+    """
+
+    TRANSIENT_GRPC_CODES = {
+        grpc.StatusCode.UNAVAILABLE,
+        grpc.StatusCode.RESOURCE_EXHAUSTED,
+    }
+    TRANSIENT_STATUS_CODES = {
+        status_code_pb2.CONN_THROTTLED,
+        status_code_pb2.MODEL_BUSY_PLEASE_RETRY,
+        status_code_pb2.RPC_REQUEST_QUEUE_FULL,
+        status_code_pb2.RPC_SERVER_UNAVAILABLE,
+    }
+    TIMEOUT_GRPC_CODES = {grpc.StatusCode.DEADLINE_EXCEEDED}
+    TIMEOUT_STATUS_CODES = {status_code_pb2.RPC_REQUEST_TIMEOUT}
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, base=None, insecure=False, timeout=30.0, max_attempts=4, initial_backoff=0.2,
+                 max_backoff=5.0):
+        self.channel = make_channel(base, insecure)
+        self.stub = V2Stub(self.channel)
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+
+    @classmethod
+    def shared(cls, base=None, insecure=None):
+        if insecure is None:
+            insecure = os.environ.get("CLARIFAI_GRPC_INSECURE", "") == "1"
+        key = (base or os.environ.get("CLARIFAI_GRPC_BASE"), insecure)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(base, insecure)
+            return cls._shared[key]
+
+    @classmethod
+    def close_shared(cls):
+        with cls._shared_lock:
+            for client in cls._shared.values():
+                client.close()
+            cls._shared.clear()
+
+    def call(self, method_name, request, metadata=(), timeout=None, token=None, idempotent=False):
+        # Raises grpc.FutureCancelledError if token is cancelled before or during the call
+        grpc_codes, status_codes = self.TRANSIENT_GRPC_CODES, self.TRANSIENT_STATUS_CODES
+        if idempotent:
+            grpc_codes, status_codes = grpc_codes | self.TIMEOUT_GRPC_CODES, status_codes | self.TIMEOUT_STATUS_CODES
+        method = getattr(self.stub, method_name)
+        for attempt in range(1, self.max_attempts + 1):
+            if token and token.cancelled:
+                raise grpc.FutureCancelledError()
+            try:
+                if token:
+                    future = method.future(request, metadata=metadata, timeout=timeout or self.timeout)
+                    token.attach(future)
+                    response = future.result()
+                else:
+                    response = method(request, metadata=metadata, timeout=timeout or self.timeout)
+            except grpc.RpcError as error:
+                if error.code() not in grpc_codes or attempt == self.max_attempts:
+                    raise
+            else:
+                if response.status.code not in status_codes or attempt == self.max_attempts:
+                    return response
+            if token:
+                token.wait(self._backoff(attempt))
+            else:
+                time.sleep(self._backoff(attempt))
+
+    def wait_ready(self, timeout=None):
+        # Connect (DNS, TCP, TLS, HTTP/2) now rather than on the first call; False if not ready within timeout
+        try:
+            grpc.channel_ready_future(self.channel).result(timeout=timeout)
+            return True
+        except grpc.FutureTimeoutError:
+            return False
+
+    def _backoff(self, attempt):
+        delay = min(self.max_backoff, self.initial_backoff * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
+
+    def close(self):
+        self.channel.close()
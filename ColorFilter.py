@@ -0,0 +1,92 @@
+def _luma_matrix(r=0.299, g=0.587, b=0.114):
+    # Every output channel gets the same ITU-R 601-2 luma, like ImageOps.grayscale
+    return (r, g, b, 0,
+            r, g, b, 0,
+            r, g, b, 0)
+
+
+def _saturation_matrix(factor, r=0.299, g=0.587, b=0.114):
+    # ImageEnhance.Color blends with the grayscale image: out = gray + factor * (rgb - gray)
+    k = 1 - factor
+    return (factor + k * r, k * g, k * b, 0,
+            k * r, factor + k * g, k * b, 0,
+            k * r, k * g, factor + k * b, 0)
+
+
+def _contrast_curve(amount):
+    # S-shaped-ish linear stretch around mid gray, clamped to 0..255
+    return [min(255, max(0, int(128 + (v - 128) * amount))) for v in range(256)]
+
+
+def _gamma_curve(gamma):
+    return [int(255 * (v / 255) ** gamma + 0.5) for v in range(256)]
+
+
+class ColorFilter:
+    """Colour filters declared as data: a 3x4 channel matrix and/or per-channel curves.
+
+    A preset is a dict with an optional ``matrix`` (12 floats, as accepted by
+    ``Image.convert(matrix=...)``) and optional ``curves`` (one 256-entry list per
+    RGB channel, applied with a single ``Image.point`` LUT). Both run in C, so a
+    preset costs one pass per stage regardless of image size.
+    """
+
+    PRESETS = {
+        'SEPIA': {
+            'matrix': (0.393, 0.769, 0.189, 0,
+                       0.349, 0.686, 0.168, 0,
+                       0.272, 0.534, 0.131, 0),
+        },
+        'GRAYSCALE': {
+            'matrix': _luma_matrix(),
+        },
+        'POP ART': {
+            'matrix': _saturation_matrix(4.0),
+        },
+        'WARM': {
+            'matrix': (1.08, 0, 0, 8,
+                       0, 1.0, 0, 0,
+                       0, 0, 0.88, -6),
+        },
+        'COOL': {
+            'matrix': (0.9, 0, 0, -6,
+                       0, 1.0, 0, 0,
+                       0, 0, 1.1, 10),
+        },
+        'VINTAGE': {
+            'matrix': _saturation_matrix(0.6),
+            'curves': (_gamma_curve(0.9), _gamma_curve(1.0), _gamma_curve(1.15)),
+        },
+        'HIGH CONTRAST': {
+            'curves': (_contrast_curve(1.4),) * 3,
+        },
+    }
+
+    @staticmethod
+    def _rgb(img):
+        # convert() always copies, so skip it when the image is already RGB
+        return img if img.mode == "RGB" else img.convert("RGB")
+
+    @staticmethod
+    def apply_matrix(img, matrix):
+        img = ColorFilter._rgb(img)
+        return img.convert("RGB", matrix=matrix)
+
+    @staticmethod
+    def apply_curves(img, curves):
+        img = ColorFilter._rgb(img)
+        lut = []
+        for curve in curves:
+            lut.extend(curve)
+        return img.point(lut)
+
+    @staticmethod
+    def apply(img, preset):
+        if isinstance(preset, str):
+            preset = ColorFilter.PRESETS[preset]
+        img = ColorFilter._rgb(img)
+        if 'matrix' in preset:
+            img = ColorFilter.apply_matrix(img, preset['matrix'])
+        if 'curves' in preset:
+            img = ColorFilter.apply_curves(img, preset['curves'])
+        return img
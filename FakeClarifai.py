@@ -0,0 +1,79 @@
+## Local stand-in for the Clarifai V2 API, for tests and benchmarks without the network
+
+import threading
+import time
+from concurrent import futures
+
+import grpc
+from clarifai_grpc.grpc.api import resources_pb2, service_pb2, service_pb2_grpc
+from clarifai_grpc.grpc.api.status import status_code_pb2, status_pb2
+
+
+class FakeV2Servicer(service_pb2_grpc.V2Servicer):
+    """Answers PostWorkflowResults with canned concepts for images and text for text inputs.
+
+    ``latency`` is added to every call, and the first ``fail_first`` calls are
+    rejected with ``fail_code`` so retry and reconnect behaviour can be measured.
+    Images whose bytes are in ``bad_images`` fail on their own, and a request
+    holding both kinds is answered with MIXED_STATUS, like the real API.
+    """
+
+    def __init__(self, concepts=("sunset", "beach", "sky"), text='Here you go: "Waves remember the sun"',
+                 latency=0.0, fail_first=0, fail_code=grpc.StatusCode.UNAVAILABLE, bad_images=()):
+        self.concepts = concepts
+        self.bad_images = set(bad_images)
+        self.text = text
+        self.latency = latency
+        self.fail_first = fail_first
+        self.fail_code = fail_code
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def PostWorkflowResults(self, request, context):
+        with self._lock:
+            self.calls += 1
+            failing = self.calls <= self.fail_first
+        if self.latency:
+            time.sleep(self.latency)
+        if failing:
+            context.abort(self.fail_code, "injected failure")
+
+        results = []
+        for workflow_input in request.inputs:
+            if workflow_input.data.image.base64 in self.bad_images:
+                results.append(resources_pb2.WorkflowResult(
+                    status=status_pb2.Status(code=status_code_pb2.INPUT_DOWNLOAD_FAILED,
+                                             description="injected bad image"),
+                    input=workflow_input,
+                ))
+                continue
+            if workflow_input.data.HasField("image"):
+                data = resources_pb2.Data(concepts=[
+                    resources_pb2.Concept(name=name, value=1.0 - i / 10) for i, name in enumerate(self.concepts)
+                ])
+            else:
+                data = resources_pb2.Data(text=resources_pb2.Text(raw=self.text))
+            results.append(resources_pb2.WorkflowResult(
+                status=status_pb2.Status(code=status_code_pb2.SUCCESS),
+                input=workflow_input,
+                outputs=[resources_pb2.Output(data=data)],
+            ))
+        failed = sum(result.status.code != status_code_pb2.SUCCESS for result in results)
+        if not failed:
+            code = status_code_pb2.SUCCESS
+        else:
+            code = status_code_pb2.MIXED_STATUS if failed < len(results) else status_code_pb2.FAILURE
+        return service_pb2.PostWorkflowResultsResponse(
+            status=status_pb2.Status(code=code),
+            results=results,
+        )
+
+
+def serve(servicer=None, port=0, max_workers=16):
+    """Start a fake V2 server on localhost; returns (server, servicer, address)."""
+    servicer = servicer or FakeV2Servicer()
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
+    service_pb2_grpc.add_V2Servicer_to_server(servicer, server)
+    port = server.add_insecure_port(f"localhost:{port}")
+    server.start()
+    return server, servicer, f"localhost:{port}"
@@ -0,0 +1,113 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from Tracer import tracer
+
+# Shared by all sessions; bounds how many generations (and warm-up renders) run at once
+BACKGROUND_WORKERS = 8
+_executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="poeticapic")
+
+
+def run_in_background(fn, *args, **kwargs):
+    return _executor.submit(fn, *args, **kwargs)
+
+
+class GenerationJob:
+    """Tagging + text generation for one upload, run off the Streamlit script thread.
+
+    The script polls ``stage``/``progress`` and may call ``cancel``, which also
+    cancels the gRPC call in flight. ``PostWorkflowResults`` is unary, so the
+    generated text arrives in one piece once the stage is ``done``. The job takes
+    ``image`` over: it is shrunk in place for tagging, so pass a fresh one.
+    """
+
+    STAGES = {
+        'queued': (0.0, "Waiting for a worker..."),
+        'tagging': (0.2, "Looking at your photo..."),
+        'generating': (0.6, "Writing your text..."),
+        'done': (1.0, "Done"),
+        'failed': (1.0, "Failed"),
+        'cancelled': (1.0, "Cancelled"),
+    }
+
+    def __init__(self, api, image, image_hash, make_prompt, original_bytes=None):
+        self.api = api
+        self.image = image
+        self.image_hash = image_hash
+        self.make_prompt = make_prompt
+        self.original_bytes = original_bytes
+        self.stage = 'queued'
+        self.tags = None
+        self.prompt = None
+        self.text = None
+        self.error = None
+        # Root span of the tag + generate calls, for the debug panel
+        self.trace = None
+        # ClarifaiClient (and with it grpc) is only imported once a generation actually starts
+        from ClarifaiClient import CancelToken
+        self._token = CancelToken()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def start(cls, *args, **kwargs):
+        job = cls(*args, **kwargs)
+        run_in_background(job._run)
+        return job
+
+    @property
+    def running(self):
+        return self.stage in ('queued', 'tagging', 'generating')
+
+    @property
+    def progress(self):
+        return self.STAGES[self.stage][0]
+
+    @property
+    def label(self):
+        return self.error or self.STAGES[self.stage][1]
+
+    def cancel(self):
+        self._token.cancel()
+        self._set_stage('cancelled', only_if_running=True)
+
+    def _set_stage(self, stage, only_if_running=False):
+        with self._lock:
+            # A cancelled job never moves on, even if its worker finishes the current step
+            if self.stage == 'cancelled' or (only_if_running and not self.running):
+                return False
+            self.stage = stage
+            return True
+
+    def _run(self):
+        with tracer.span('generation') as self.trace:
+            self._generate()
+            if self.stage != 'done':
+                self.trace.status = 'error' if self.stage == 'failed' else self.stage
+
+    def _generate(self):
+        import grpc
+
+        try:
+            if not self._set_stage('tagging'):
+                return
+            self.tags = self.api.get_image_tags(self.image, self.original_bytes, self.image_hash, token=self._token,
+                                                in_place=True)
+            if not self.tags:
+                self.error = self.api.last_error or "Failed to generate text. Please try again."
+                self._set_stage('failed')
+                return
+
+            if not self._set_stage('generating'):
+                return
+            self.prompt = self.make_prompt(self.tags)
+            self.text = self.api.get_text(self.prompt, token=self._token)
+            if not self.text:
+                self.error = self.api.last_error or "Failed to generate text. Please try again."
+                self._set_stage('failed')
+                return
+            self._set_stage('done')
+        except grpc.FutureCancelledError:
+            self._set_stage('cancelled')
+        except Exception as error:
+            self.error = f"Generation failed: {error}"
+            self._set_stage('failed')
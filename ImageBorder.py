@@ -1,211 +1,334 @@
-import math
 import random
 
-from PIL import Image, ImageOps, ImageDraw, ImageFilter, ImageChops, ImageFont
+import numpy as np
+from PIL import Image, ImageDraw, ImageColor
+
+from LRUCache import LRUCache
+from TextLayout import TextLayout
+
+# Decoded textures and pre-tiled border strips, shared by every session in the process
+TEXTURE_CACHE_BYTES = 64 * 1024 * 1024
+_texture_cache = LRUCache(TEXTURE_CACHE_BYTES)
+WOOD_TEXTURE_PATH = 'frame.jpg'
+
+
+def _palette(colors):
+    return np.array([ImageColor.getrgb(color) for color in colors], dtype=np.uint8)
+
+
+def _border_strips(size, left, top, right, bottom):
+    # (left, upper, right, lower) boxes of the four border strips, without overlaps
+    width, height = size
+    return [
+        (0, 0, width, top),
+        (0, height - bottom, width, height),
+        (0, top, left, height - bottom),
+        (width - right, top, width, height - bottom),
+    ]
+
+
+def _caption_font(size=12):
+    return TextLayout.font(size)
+
+
+def _strips_around(canvas, box):
+    return _border_strips(canvas.size, box[0], box[1], canvas.width - box[2], canvas.height - box[3])
+
+
+def _filmstrip_mask(size):
+    # Dots on every 4th pixel where (x + y) % 8 == 0, i.e. two interleaved 8px lattices; one mask per canvas size
+    def build():
+        mask = np.zeros((size[1], size[0]), dtype=np.uint8)
+        mask[0::8, 0::8] = 255
+        mask[4::8, 4::8] = 255
+        return Image.fromarray(mask)
+    return _texture_cache.get_or_create(("filmstrip_mask", size), build)
 
 
 class ImageBorder:
+    """Border renderers. The public methods take a photo and return it framed on a new canvas.
+
+    Each one is a BorderSpec in BORDERS: the padding and fill describe the canvas,
+    and the private ``_*`` functions draw the decoration in place on a canvas that
+    already holds the photo at ``box`` (left, upper, right, lower).
+    """
 
     @staticmethod
     def basic_polaroid(img):
-        width, height = img.size
-        top_border = int(height * 0.02)
-        side_border = int(width * 0.02)
-        bottom_border = int(height * 0.25)
-        borders = (side_border, top_border, side_border, bottom_border)
-        return ImageOps.expand(img, border=borders, fill="white")
+        return BORDERS['Polaroids'].apply(img)
+
     @staticmethod
     def vintage_frame(img):
-        width, height = img.size
-        border_width = int(width * 0.1)
-        border_color = (248, 227, 196)  # Cream color for a vintage feel
-        img = ImageOps.expand(img, border=border_width, fill=border_color)
-        draw = ImageDraw.Draw(img)
-        for i in range(border_width):
-            draw.rectangle([i, i, width - i - 1, height - i - 1],
-                           outline=(240 - (i // 3), 220 - (i // 3), 190 - (i // 3)))
-        return img
-    
+        return BORDERS['Vintage Frame'].apply(img)
+
     @staticmethod
     def framed_border(img, text=None):
-        width, height = img.size
-        frame_width = int(width * 0.08)
-        frame_color = (100, 100, 100)  # Dark gray frame
-
-        img = ImageOps.expand(img, border=frame_width, fill=frame_color)
-
-        if text:
-            draw = ImageDraw.Draw(img)
-            text_font = ImageFont.truetype("path_to_your_font.ttf", 12)
-            text_width, text_height = draw.textsize(text, font=text_font)
-            text_position = (frame_width // 2, (height - text_height) // 2)
-            draw.text(text_position, text, fill=(255, 255, 255), font=text_font)
+        return BORDERS['Framed Border'].apply(img, text=text)
 
-        return img
-    
     @staticmethod
     def grunge_border(img, text=None):
-        width, height = img.size
-        border_width = int(width * 0.05)
-        border_color = (160, 160, 160)  # Grayish border
+        return BORDERS['Grunge Border'].apply(img, text=text)
 
-        img = ImageOps.expand(img, border=border_width, fill=border_color)
+    @staticmethod
+    def filmstrip_border(img, text=None):
+        return BORDERS['Filmstrip Border'].apply(img, text=text)
 
-        if text:
-            draw = ImageDraw.Draw(img)
-            text_font = ImageFont.truetype("path_to_your_font.ttf", 12)
-            text_width, text_height = draw.textsize(text, font=text_font)
-            text_position = ((width - text_width) // 2, height + border_width)
-            draw.text(text_position, text, fill=(0, 0, 0), font=text_font)
+    @staticmethod
+    def bohemian_bliss_frame(img, seed=None):
+        return BORDERS['Bohemian Bliss Frame'].apply(img, seed=seed)
 
-        return img
     @staticmethod
-    def filmstrip_border(img, text=None):
-        border_color = "white"
-        left_border, top_border, right_border, bottom_border = 10, 50, 10, 10
-        new_img = Image.new("RGB", (img.width + left_border + right_border,
-                                    img.height + top_border + bottom_border), border_color)
-        new_img.paste(img, (left_border, top_border))
-        draw = ImageDraw.Draw(new_img)
-        for x in range(0, new_img.width, 4):
-            for y in range(0, new_img.height, 4):
-                if (x + y) % 8 == 0:
-                    draw.point((x, y), fill="brown")
-        return new_img
+    def pixel_frame(img, seed=None):
+        return BORDERS['Pixel Frame'].apply(img, seed=seed)
 
+    @staticmethod
+    def cartoon_frame(img, seed=None):
+        return BORDERS['Cartoon Frame'].apply(img, seed=seed)
 
+    @staticmethod
+    def bubble_frame(img, seed=None):
+        return BORDERS['Bubble Frame'].apply(img, seed=seed)
 
     @staticmethod
-    def bohemian_bliss_frame(img):
-        # Bohemian Bliss: Patterned borders with a tribal touch
-        left_border, top_border, right_border, bottom_border = 20, 20, 20, 60
-        pattern_colors = ["#FFD700", "#FF4500", "#4B0082", "#6B8E23"]
-        new_img = Image.new("RGB", (img.width + left_border + right_border,
-                                    img.height + top_border + bottom_border), "#D2B48C")  # Tan background
-        new_img.paste(img, (left_border, top_border))
-        draw = ImageDraw.Draw(new_img)
+    def glitch_frame(img, seed=None):
+        return BORDERS['Glitch Frame'].apply(img, seed=seed)
 
-        for i in range(0, left_border):
-            for y in range(0, new_img.height):
-                if (i + y) % 4 == 0:
-                    draw.point((i, y), fill=random.choice(pattern_colors))
+    @staticmethod
+    def wooden_frame(img):
+        return BORDERS['Wooden Frame'].apply(img)
+
+    @staticmethod
+    def _vintage(canvas, box):
+        width, height = box[2] - box[0], box[3] - box[1]
+        border_width = box[0]
+        draw = ImageDraw.Draw(canvas)
+        for i in range(border_width):
+            draw.rectangle([i, i, width - i - 1, height - i - 1],
+                           outline=(240 - (i // 3), 220 - (i // 3), 190 - (i // 3)))
 
-        for i in range(new_img.width - right_border, new_img.width):
-            for y in range(0, new_img.height):
-                if (i + y) % 4 == 0:
-                    draw.point((i, y), fill=random.choice(pattern_colors))
+    @staticmethod
+    def _framed(canvas, box, text=None):
+        if text:
+            frame_width, height = box[0], box[3] - box[1]
+            draw = ImageDraw.Draw(canvas)
+            text_font = _caption_font()
+            text_bbox = draw.textbbox((0, 0), text, font=text_font)
+            text_height = text_bbox[3] - text_bbox[1]
+            text_position = (frame_width // 2, (height - text_height) // 2)
+            draw.text(text_position, text, fill=(255, 255, 255), font=text_font)
 
-        for i in range(0, top_border):
-            for x in range(0, new_img.width):
-                if (i + x) % 4 == 0:
-                    draw.point((x, i), fill=random.choice(pattern_colors))
+    @staticmethod
+    def _grunge(canvas, box, text=None):
+        if text:
+            border_width, width, height = box[0], box[2] - box[0], box[3] - box[1]
+            draw = ImageDraw.Draw(canvas)
+            text_font = _caption_font()
+            text_bbox = draw.textbbox((0, 0), text, font=text_font)
+            text_width = text_bbox[2] - text_bbox[0]
+            text_position = ((width - text_width) // 2, height + border_width)
+            draw.text(text_position, text, fill=(0, 0, 0), font=text_font)
 
-        for i in range(new_img.height - bottom_border, new_img.height):
-            for x in range(0, new_img.width):
-                if (i + x) % 4 == 0:
-                    draw.point((x, i), fill=random.choice(pattern_colors))
+    @staticmethod
+    def _filmstrip(canvas, box, text=None):
+        # The dots cover the photo too, as they always have
+        canvas.paste(ImageColor.getrgb("brown"), (0, 0) + canvas.size, _filmstrip_mask(canvas.size))
+        if text:
+            # Written on the wide top strip, like a label on the film
+            draw = ImageDraw.Draw(canvas)
+            text_font = _caption_font()
+            text_bbox = draw.textbbox((0, 0), text, font=text_font)
+            text_height = text_bbox[3] - text_bbox[1]
+            draw.text((box[0], (box[1] - text_height) // 2 - text_bbox[1]), text, fill=(0, 0, 0), font=text_font)
 
-        return new_img
+    @staticmethod
+    def _bohemian_bliss(canvas, box, seed=None):
+        # Bohemian Bliss: Patterned borders with a tribal touch
+        pattern_colors = _palette(["#FFD700", "#FF4500", "#4B0082", "#6B8E23"])
+        rng = np.random.default_rng(seed)
+
+        # The strips only hold the tan background so far, so build them from that instead of reading them back
+        background = canvas.getpixel((0, 0))
+        for strip_box in _strips_around(canvas, box):
+            strip = np.empty((strip_box[3] - strip_box[1], strip_box[2] - strip_box[0], 3), dtype=np.uint8)
+            strip[:] = background
+            # Diagonal stripes: every pixel on (x + y) % 4 == 0 gets a random pattern colour
+            ys, xs = np.ogrid[strip_box[1]:strip_box[3], strip_box[0]:strip_box[2]]
+            mask = (xs + ys) % 4 == 0
+            strip[mask] = pattern_colors[rng.integers(len(pattern_colors), size=int(mask.sum()))]
+            canvas.paste(Image.fromarray(strip), strip_box[:2])
 
     @staticmethod
-    def pixel_frame(img):
+    def _pixel(canvas, box, seed=None):
         # Crystalline Contour: Shimmering crystal-like edges
-        border_color = "#A9ACB6"
-        left_border, top_border, right_border, bottom_border = 50, 50, 50, 50
-        new_img = Image.new("RGB", (img.width + left_border + right_border,
-                                    img.height + top_border + bottom_border), border_color)
-        new_img.paste(img, (left_border, top_border))
-        draw = ImageDraw.Draw(new_img)
-        for x in range(0, new_img.width, 5):
-            for y in [y for y in range(0, top_border, 5)] + [y for y in
-                                                             range(new_img.height - bottom_border, new_img.height, 5)]:
-                crystal_color = random.choice(["#FFFFFF", "#D3D3D3", "#C0C0C0"])
-                draw.rectangle((x, y, x + 5, y + 5), fill=crystal_color)
-        for y in range(0, new_img.height, 5):
-            for x in [x for x in range(0, left_border, 5)] + [x for x in
-                                                              range(new_img.width - right_border, new_img.width, 5)]:
-                crystal_color = random.choice(["#FFFFFF", "#D3D3D3", "#C0C0C0"])
-                draw.rectangle((x, y, x + 5, y + 5), fill=crystal_color)
-
-        return new_img
-    @staticmethod
-    def cartoon_frame(img):
+        crystal_colors = _palette(["#FFFFFF", "#D3D3D3", "#C0C0C0"])
+        rng = np.random.default_rng(seed)
+        cell = 5
+
+        for strip_box in _strips_around(canvas, box):
+            width, height = strip_box[2] - strip_box[0], strip_box[3] - strip_box[1]
+            # One random colour per 5x5 cell, blown up to pixels with repeat
+            cells = rng.integers(len(crystal_colors), size=(-(-height // cell), -(-width // cell)))
+            strip = crystal_colors[cells].repeat(cell, axis=0).repeat(cell, axis=1)[:height, :width]
+            canvas.paste(Image.fromarray(np.ascontiguousarray(strip)), strip_box[:2])
+
+    @staticmethod
+    def _cartoon(canvas, box, seed=None):
         # Holographic Halo: Shimmering border with a holographic effect
-        border_color = "#DAA520"  # goldenrod
-        left_border, top_border, right_border, bottom_border = 10, 20, 10, 30
-        new_img = Image.new("RGB", (img.width + left_border + right_border,
-                                    img.height + top_border + bottom_border), border_color)
-        new_img.paste(img, (left_border, top_border))
-        draw = ImageDraw.Draw(new_img)
+        top_border, bottom_border = box[1], canvas.height - box[3]
+        draw = ImageDraw.Draw(canvas)
+        rng = random.Random(seed)
         halo_colors = ["#EE82EE", "#ADD8E6", "#FFB6C1", "#90EE90"]
 
         for i in range(100):  # Random holographic patterns
-            x = random.randint(0, new_img.width)
-            y = random.randint(0, top_border)
-            s = random.randint(5, 20)
-            draw.rectangle((x - s, y - s, x + s, y + s), fill=random.choice(halo_colors), outline="#DAA520", width=2)
+            x = rng.randint(0, canvas.width)
+            y = rng.randint(0, top_border)
+            s = rng.randint(5, 20)
+            draw.rectangle((x - s, y - s, x + s, y + s), fill=rng.choice(halo_colors), outline="#DAA520", width=2)
 
-            y = random.randint(new_img.height - bottom_border, new_img.height)
-            draw.rectangle((x - s, y - s, x + s, y + s), fill=random.choice(halo_colors), outline="#DAA520", width=2)
-
-        return new_img
+            y = rng.randint(canvas.height - bottom_border, canvas.height)
+            draw.rectangle((x - s, y - s, x + s, y + s), fill=rng.choice(halo_colors), outline="#DAA520", width=2)
 
     @staticmethod
-    def bubble_frame(img):
+    def _bubble(canvas, box, seed=None):
         # Ice Frost: Icy, frosty edge around the image
-        border_thickness = 30
-        new_img = Image.new("RGB", (img.width + 2 * border_thickness, img.height + 2 * border_thickness),
-                            "pink")  # Light blue background
-        new_img.paste(img, (border_thickness, border_thickness))
-
-        draw = ImageDraw.Draw(new_img)
+        border_thickness = box[1]
+        draw = ImageDraw.Draw(canvas)
+        rng = random.Random(seed)
         for _ in range(100):
-            x = random.randint(0, new_img.width)
-            y = random.randint(0, border_thickness)
-            length = random.randint(10, 30)
+            x = rng.randint(0, canvas.width)
+            y = rng.randint(0, border_thickness)
+            length = rng.randint(10, 30)
             draw.arc((x - length, y - length, x + length, y + length), 0, 180, fill="#FFFFFF")
 
-            y = new_img.height - y
+            y = canvas.height - y
             draw.arc((x - length, y - length, x + length, y + length), 180, 360, fill="#FFFFFF")
 
-        return new_img
-
     @staticmethod
-    def glitch_frame(img):
-        # Adds a digital glitch effect on the borders
-        border_thickness = 40
-        new_img = ImageOps.expand(img, border=border_thickness, fill='black')
-        for y in range(new_img.height):
-            if y % 15 == 0:
-                shift = int((border_thickness / 2) * (0.5 - random.random()))
-                part = new_img.crop((0, y, new_img.width, y + 15))
-                new_img.paste(part, (shift, y))
-        return new_img
+    def _glitch(canvas, box, seed=None):
+        # Adds a digital glitch effect on the borders: every 15-row band is shifted sideways in place
+        border_thickness = box[0]
+        rng = random.Random(seed)
+        for y in range(0, canvas.height, 15):
+            shift = int((border_thickness / 2) * (0.5 - rng.random()))
+            if shift:
+                canvas.paste(canvas.crop((0, y, canvas.width, y + 15)), (shift, y))
 
     @staticmethod
-    def wooden_frame(img):
-        texture_path = 'frame.jpg'
-        border_thickness = 50
-
-        # Load the wood texture
-        texture = Image.open(texture_path)
-
-        # Create an expanded image with white borders
-        bordered_img = Image.new('RGB', (img.width + 2 * border_thickness, img.height + 2 * border_thickness), 'white')
-        bordered_img.paste(img, (border_thickness, border_thickness))
+    def _wood_texture(texture_path):
+        def load():
+            with Image.open(texture_path) as texture:
+                return texture.convert("RGB")
+        return _texture_cache.get_or_create(("texture", texture_path), load)
 
-        # Create the wooden texture mask: White for areas to retain the wood texture, black for other areas
-        mask = Image.new('L', bordered_img.size, 0)
-        mask.paste(255,
-                   (border_thickness, border_thickness, img.width + border_thickness, img.height + border_thickness))
-
-        # Tile the wood texture to cover the entire image
-        tiled_texture = Image.new('RGB', bordered_img.size)
-        for i in range(0, bordered_img.width, texture.width):
-            for j in range(0, bordered_img.height, texture.height):
-                tiled_texture.paste(texture, (i, j))
-
-        # Composite the bordered image and the tiled texture using the mask
-        result = Image.composite(bordered_img, tiled_texture, mask)
+    @staticmethod
+    def _wood_strips(texture_path, size, border_thickness):
+        # Pre-tiled top, bottom, left and right strips for one output size
+        def build():
+            texture = ImageBorder._wood_texture(texture_path)
+            strips = []
+            for box in _border_strips(size, border_thickness, border_thickness, border_thickness, border_thickness):
+                strip = Image.new("RGB", (box[2] - box[0], box[3] - box[1]))
+                # Keep the tiling anchored at the canvas origin so the strips line up at the corners
+                for i in range(box[0] - box[0] % texture.width, box[2], texture.width):
+                    for j in range(box[1] - box[1] % texture.height, box[3], texture.height):
+                        strip.paste(texture, (i - box[0], j - box[1]))
+                strips.append((box, strip))
+            return tuple(strips)
+        return _texture_cache.get_or_create(("strips", texture_path, size, border_thickness), build)
 
-        return result
+    @staticmethod
+    def _wooden(canvas, box):
+        # Only the four border strips get wood
+        for strip_box, strip in ImageBorder._wood_strips(WOOD_TEXTURE_PATH, canvas.size, box[0]):
+            canvas.paste(strip, strip_box[:2])
+
+
+def warm_up(texture_path=WOOD_TEXTURE_PATH):
+    # Decode the wood texture and load the caption font before the first border needs them.
+    # Not on ImageBorder, whose public methods are all borders
+    ImageBorder._wood_texture(texture_path)
+    _caption_font()
+
+
+class BorderSpec:
+    """Everything the app needs to know about one border, without rendering it.
+
+    ``padding`` maps the photo (width, height) to the (left, top, right, bottom)
+    border widths and ``fill`` is the canvas colour, so the output size is known
+    before anything is drawn. ``decorate(canvas, box, **options)`` draws the
+    border in place around the photo at ``box``; ``params`` lists the optional
+    keyword arguments it accepts (e.g. ``text``, ``seed``). ``deterministic`` is
+    True when the same input always gives the same pixels (seeded borders are
+    deterministic only with a seed).
+    """
+
+    def __init__(self, name, padding, fill, decorate=None, params=(), deterministic=True):
+        self.name = name
+        self.padding = padding
+        self.fill = fill
+        self.decorate = decorate
+        self.params = tuple(params)
+        self.deterministic = deterministic
+
+    def size(self, size):
+        left, top, right, bottom = self.padding(size)
+        return size[0] + left + right, size[1] + top + bottom
+
+    def box(self, size):
+        left, top, _, _ = self.padding(size)
+        return left, top, left + size[0], top + size[1]
+
+    def apply(self, img, **options):
+        # The only full-size allocation: the final canvas, with the photo pasted straight into its interior
+        canvas = Image.new("RGB", self.size(img.size), self.fill)
+        box = self.box(img.size)
+        canvas.paste(img, box[:2])
+        if self.decorate:
+            kwargs = {key: value for key, value in options.items() if key in self.params and value is not None}
+            self.decorate(canvas, box, **kwargs)
+        return canvas
+
+    def is_deterministic(self, seed=None):
+        return self.deterministic or ('seed' in self.params and seed is not None)
+
+
+BORDERS = {}
+
+
+def register_border(name, padding, fill, decorate=None, params=(), deterministic=True):
+    BORDERS[name] = BorderSpec(name, padding, fill, decorate, params, deterministic)
+    return BORDERS[name]
+
+
+def _padded(left, top, right, bottom):
+    return lambda size: (left, top, right, bottom)
+
+
+def _relative(ratio):
+    def padding(size):
+        border = int(size[0] * ratio)
+        return border, border, border, border
+    return padding
+
+
+def _polaroid_padding(size):
+    width, height = size
+    return int(width * 0.02), int(height * 0.02), int(width * 0.02), int(height * 0.25)
+
+
+register_border('Polaroids', _polaroid_padding, "white")
+register_border('Vintage Frame', _relative(0.1), (248, 227, 196), ImageBorder._vintage)  # Cream color for a vintage feel
+register_border('Filmstrip Border', _padded(10, 50, 10, 10), "white", ImageBorder._filmstrip, params=('text',))
+register_border('Grunge Border', _relative(0.05), (160, 160, 160), ImageBorder._grunge, params=('text',))
+register_border('Framed Border', _relative(0.08), (100, 100, 100), ImageBorder._framed, params=('text',))
+register_border('Glitch Frame', _padded(40, 40, 40, 40), "black", ImageBorder._glitch, params=('seed',),
+                deterministic=False)
+register_border('Wooden Frame', _padded(50, 50, 50, 50), "black", ImageBorder._wooden)
+register_border('Cartoon Frame', _padded(10, 20, 10, 30), "#DAA520", ImageBorder._cartoon, params=('seed',),
+                deterministic=False)
+register_border('Pixel Frame', _padded(50, 50, 50, 50), "#A9ACB6", ImageBorder._pixel, params=('seed',),
+                deterministic=False)
+register_border('Bubble Frame', _padded(30, 30, 30, 30), "pink", ImageBorder._bubble, params=('seed',),
+                deterministic=False)
+register_border('Bohemian Bliss Frame', _padded(20, 20, 20, 60), "#D2B48C", ImageBorder._bohemian_bliss,
+                params=('seed',), deterministic=False)
@@ -0,0 +1,69 @@
+import hashlib
+import os
+import threading
+import time
+
+
+class ImageStore:
+    """Optional on-disk copy of uploads and results, named by content hash.
+
+    Two users uploading ``photo.jpg`` no longer overwrite each other, storing
+    the same bytes twice is a no-op, and ``gc`` keeps the directory under
+    ``max_bytes`` and drops files not used for ``max_age`` seconds, oldest first.
+    ``put`` only scans the directory for ``gc`` every ``gc_interval`` seconds,
+    or sooner once the bytes written since the last scan could take it over
+    ``max_bytes``.
+    """
+
+    def __init__(self, directory, max_bytes=500 * 1024 * 1024, max_age=7 * 24 * 3600, gc_interval=60.0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.gc_interval = gc_interval
+        self._lock = threading.Lock()
+        # Directory size as of the last gc plus everything written since; a scan on the first put sets it
+        self._total = max_bytes + 1
+        self._last_gc = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, data, extension):
+        name = hashlib.sha256(data).hexdigest()[:32] + "." + extension
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            if os.path.exists(path):
+                # Counts as a use for gc
+                os.utime(path)
+            else:
+                temp_path = path + ".tmp"
+                with open(temp_path, "wb") as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+                self._total += len(data)
+            if self._total > self.max_bytes or time.monotonic() - self._last_gc >= self.gc_interval:
+                self._gc()
+        return path
+
+    def gc(self):
+        with self._lock:
+            self._gc()
+
+    def _gc(self):
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_bytes and now - mtime <= self.max_age:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._total = total
+        self._last_gc = time.monotonic()
@@ -0,0 +1,49 @@
+import hashlib
+import threading
+
+from LRUCache import LRUCache
+
+
+class RenderCache:
+    """Content-addressed cache for the intermediate images of a render.
+
+    Keys are tuples that start with the content hash of the upload and append
+    the parameters of every stage applied so far, e.g.
+    ``(hash, ('filter', 'BLUR'), ('resize', (400, 400)), ('border', 'Pixel Frame', 7, None))``.
+    Changing a late stage therefore reuses every earlier stage. Cached images
+    are shared and must not be modified in place.
+    """
+
+    def __init__(self, max_bytes):
+        self._cache = LRUCache(max_bytes)
+        self._lock = threading.Lock()
+        self._stage_stats = {}
+
+    @staticmethod
+    def content_hash(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def stage(self, key, factory, cacheable=True):
+        stage_name = key[-1][0]
+        if not cacheable:
+            self._count(stage_name, hit=False)
+            return factory()
+        value = self._cache.get(key)
+        self._count(stage_name, hit=value is not None)
+        if value is None:
+            value = self._cache.put(key, factory())
+        return value
+
+    def _count(self, stage_name, hit):
+        with self._lock:
+            counts = self._stage_stats.setdefault(stage_name, {"hits": 0, "misses": 0})
+            counts["hits" if hit else "misses"] += 1
+
+    def stats(self):
+        stats = self._cache.stats()
+        with self._lock:
+            stats["stages"] = {name: dict(counts) for name, counts in self._stage_stats.items()}
+        return stats
+
+    def clear(self):
+        self._cache.clear()
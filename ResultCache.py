@@ -0,0 +1,181 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+
+from PIL import Image
+
+# Hits only bump last_used (for trimming); they are written together, at most this many at a time or this often
+HIT_FLUSH_BATCH = 64
+HIT_FLUSH_SECONDS = 5.0
+
+
+class ResultCache:
+    """Persistent cache for Clarifai results, so repeated clicks don't pay for new API calls.
+
+    Tags are keyed by the upload's content hash and also indexed by a 64-bit
+    perceptual hash (dHash), so a re-encoded or slightly edited copy of the
+    same photo still hits. Generated text is keyed by the normalised prompt.
+    Entries expire after ``ttl`` seconds and each table is trimmed to the
+    ``max_entries`` most recently used rows. Pass ``":memory:"`` as the path
+    for a cache that does not survive restarts.
+
+    The dHash is split into ``phash_distance + 1`` bands and each band is
+    indexed: two hashes within ``phash_distance`` bits of each other agree
+    exactly on at least one band, so a lookup only compares the rows that share
+    a band instead of scanning the table.
+    """
+
+    def __init__(self, path, ttl=7 * 24 * 3600, max_entries=10_000, phash_distance=4):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.phash_distance = phash_distance
+        self.hits = 0
+        self.misses = 0
+        self._bands = self._band_layout(phash_distance + 1)
+        self._touched = {"tags": {}, "texts": {}}
+        self._flushed = time.monotonic()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA foreign_keys = ON")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS tags (
+                key TEXT PRIMARY KEY, phash TEXT, value TEXT NOT NULL,
+                created REAL NOT NULL, last_used REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS tags_phash ON tags (phash);
+            CREATE TABLE IF NOT EXISTS tag_bands (
+                key TEXT NOT NULL REFERENCES tags (key) ON DELETE CASCADE,
+                bands INTEGER NOT NULL, band INTEGER NOT NULL, bits INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS tag_bands_bits ON tag_bands (bands, band, bits);
+            CREATE INDEX IF NOT EXISTS tag_bands_key ON tag_bands (key);
+            CREATE TABLE IF NOT EXISTS texts (
+                key TEXT PRIMARY KEY, value TEXT NOT NULL,
+                created REAL NOT NULL, last_used REAL NOT NULL);
+        """)
+        # Rows written before the band index existed, or under another phash_distance
+        rows = self._db.execute("SELECT key, phash FROM tags WHERE phash IS NOT NULL AND key NOT IN "
+                                "(SELECT key FROM tag_bands WHERE bands = ?)", (len(self._bands),)).fetchall()
+        for key, phash in rows:
+            self._index_bands(key, int(phash, 16))
+        self._db.commit()
+
+    @staticmethod
+    def perceptual_hash(image):
+        # dHash: compare neighbouring pixels of a 9x8 grayscale thumbnail
+        small = image.convert("L").resize((9, 8), Image.Resampling.LANCZOS)
+        pixels = small.tobytes()
+        bits = 0
+        for row in range(8):
+            for col in range(8):
+                bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+        return bits
+
+    @staticmethod
+    def normalize_prompt(prompt):
+        return re.sub(r"\s+", " ", prompt).strip().lower()
+
+    def get_tags(self, content_hash=None, phash=None):
+        now = time.time()
+        with self._lock:
+            row = None
+            if content_hash:
+                row = self._db.execute("SELECT key, value FROM tags WHERE key = ? AND created > ?",
+                                       (content_hash, now - self.ttl)).fetchone()
+            if row is None and phash is not None:
+                row = self._nearest_phash(phash, now)
+            return self._hit("tags", row, now, json.loads)
+
+    def put_tags(self, content_hash, tags, phash=None):
+        key = content_hash or "phash:%016x" % phash
+        # Replacing the row drops its old bands through the foreign key
+        self._put("INSERT OR REPLACE INTO tags (key, phash, value, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                  "tags", key, None if phash is None else "%016x" % phash, json.dumps(tags),
+                  after=None if phash is None else lambda: self._index_bands(key, phash))
+
+    def get_text(self, prompt):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT key, value FROM texts WHERE key = ? AND created > ?",
+                                   (self.normalize_prompt(prompt), now - self.ttl)).fetchone()
+            return self._hit("texts", row, now, str)
+
+    def put_text(self, prompt, text):
+        self._put("INSERT OR REPLACE INTO texts (key, value, created, last_used) VALUES (?, ?, ?, ?)",
+                  "texts", self.normalize_prompt(prompt), text)
+
+    def flush(self):
+        # Writes out the last_used times of hits not yet written
+        with self._lock:
+            self._flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "tags": self._db.execute("SELECT COUNT(*) FROM tags").fetchone()[0],
+                "texts": self._db.execute("SELECT COUNT(*) FROM texts").fetchone()[0],
+            }
+
+    @staticmethod
+    def _band_layout(count):
+        # (shift, mask) of each band, splitting the 64 bits as evenly as possible
+        layout, shift = [], 0
+        for i in range(count):
+            width = 64 // count + (i < 64 % count)
+            layout.append((shift, (1 << width) - 1))
+            shift += width
+        return layout
+
+    def _index_bands(self, key, phash):
+        self._db.executemany("INSERT INTO tag_bands (key, bands, band, bits) VALUES (?, ?, ?, ?)",
+                             [(key, len(self._bands), i, phash >> shift & mask)
+                              for i, (shift, mask) in enumerate(self._bands)])
+
+    def _nearest_phash(self, phash, now):
+        # Each OR term names the whole index, so SQLite answers it with one index search per band
+        match = " OR ".join(["(b.bands = ? AND b.band = ? AND b.bits = ?)"] * len(self._bands))
+        values = [value for i, (shift, mask) in enumerate(self._bands)
+                  for value in (len(self._bands), i, phash >> shift & mask)]
+        best, best_distance = None, self.phash_distance + 1
+        for key, value, other in self._db.execute(
+                "SELECT DISTINCT t.key, t.value, t.phash FROM tag_bands b JOIN tags t ON t.key = b.key "
+                f"WHERE ({match}) AND t.created > ?", (*values, now - self.ttl)):
+            distance = bin(phash ^ int(other, 16)).count("1")
+            if distance < best_distance:
+                best, best_distance = (key, value), distance
+        return best
+
+    def _hit(self, table, row, now, decode):
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touched[table][row[0]] = now
+        if (sum(map(len, self._touched.values())) >= HIT_FLUSH_BATCH
+                or time.monotonic() - self._flushed >= HIT_FLUSH_SECONDS):
+            self._flush()
+        return decode(row[1])
+
+    def _flush(self):
+        for table, touched in self._touched.items():
+            if touched:
+                self._db.executemany(f"UPDATE {table} SET last_used = ? WHERE key = ?",
+                                     [(now, key) for key, now in touched.items()])
+                touched.clear()
+        self._db.commit()
+        self._flushed = time.monotonic()
+
+    def _put(self, sql, table, key, *values, after=None):
+        now = time.time()
+        with self._lock:
+            # Trimming goes by last_used, so pending hits are written first
+            self._flush()
+            self._db.execute(sql, (key, *values, now, now))
+            if after:
+                after()
+            self._db.execute(f"DELETE FROM {table} WHERE created <= ?", (now - self.ttl,))
+            self._db.execute(f"DELETE FROM {table} WHERE key NOT IN "
+                             f"(SELECT key FROM {table} ORDER BY last_used DESC LIMIT ?)", (self.max_entries,))
+            self._db.commit()
@@ -0,0 +1,93 @@
+import functools
+
+from PIL import ImageFont
+
+FONT_PATH = "Arial.ttf"
+LINE_SPACING = 4
+
+
+class Line:
+    def __init__(self, text, bbox):
+        self.text = text
+        # bbox relative to the drawing origin, as returned by FreeTypeFont.getbbox
+        self.bbox = bbox
+        self.width = bbox[2] - bbox[0]
+
+
+class Layout:
+    """Wrapped lines plus the block size for one (text, font, size, max_width)."""
+
+    def __init__(self, font, lines, line_height):
+        self.font = font
+        self.lines = lines
+        self.line_height = line_height
+        self.width = max((line.width for line in lines), default=0)
+        self.height = len(lines) * line_height - LINE_SPACING if lines else 0
+
+
+class TextLayout:
+    """Font loading, measuring and pixel-width wrapping, all memoised per process.
+
+    Fonts are cached by (path, size), measurements by (path, size, string) and
+    whole layouts by their inputs, so a Streamlit rerun with the same text and
+    options does no FreeType work at all.
+    """
+
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def font(size, path=FONT_PATH):
+        try:
+            return ImageFont.truetype(path, size)
+        except IOError:
+            print("Using default font. Font size will not be adjustable.")
+            return ImageFont.load_default()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=8192)
+    def measure(text, size, path=FONT_PATH):
+        return TextLayout.font(size, path).getbbox(text)
+
+    @staticmethod
+    def line_height(size, path=FONT_PATH):
+        bbox = TextLayout.measure("Ag", size, path)
+        return bbox[3] + LINE_SPACING
+
+    @staticmethod
+    def wrap(text, size, max_width, path=FONT_PATH):
+        # Greedy word wrap by rendered width; a single word wider than max_width gets its own line
+        lines = []
+        for paragraph in text.splitlines() or [""]:
+            current = ""
+            for word in paragraph.split():
+                candidate = f"{current} {word}" if current else word
+                bbox = TextLayout.measure(candidate, size, path)
+                if current and bbox[2] - bbox[0] > max_width:
+                    lines.append(current)
+                    current = word
+                else:
+                    current = candidate
+            if current:
+                lines.append(current)
+        return lines
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def layout(text, size, max_width, path=FONT_PATH):
+        lines = [Line(line, TextLayout.measure(line, size, path))
+                 for line in TextLayout.wrap(text, size, max_width, path)]
+        return Layout(TextLayout.font(size, path), lines, TextLayout.line_height(size, path))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def fit(text, max_width, max_height, min_size=8, max_size=72, path=FONT_PATH):
+        """Largest font size in [min_size, max_size] whose wrapped text fits the box."""
+        best = min_size
+        low, high = min_size, max_size
+        while low <= high:
+            size = (low + high) // 2
+            layout = TextLayout.layout(text, size, max_width, path)
+            if layout.width <= max_width and layout.height <= max_height:
+                best, low = size, size + 1
+            else:
+                high = size - 1
+        return best
@@ -0,0 +1,237 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram bounds in seconds, from a cached lookup up to a slow workflow call
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Span:
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.parent = parent
+        # Hex ids in the sizes OpenTelemetry uses, so exported traces load into its tools
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.attributes = dict(attributes or {})
+        self.children = []
+        self.status = 'ok'
+        self.start_ns = time.time_ns()
+        self.seconds = None
+        self._start = time.perf_counter()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def walk(self, depth=0):
+        yield depth, self
+        for child in self.children:
+            yield from child.walk(depth + 1)
+
+
+class Metrics:
+    """Counters, gauges and histograms, rendered in the Prometheus text format."""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        # (name, labels) -> [count per bucket, sum, count]
+        self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for kind, values in (('counter', self._counters), ('gauge', self._gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (other, labels), value in sorted(values.items()):
+                        if other == name:
+                            lines.append(f"{name}{_labels(labels)} {value}")
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (other, labels), (buckets, total, count) in sorted(self._histograms.items()):
+                    if other != name:
+                        continue
+                    for bound, bucket_count in zip(self.buckets, buckets):
+                        lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {bucket_count}")
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{_labels(labels)} {total}")
+                    lines.append(f"{name}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+class Tracer:
+    """Nested timing spans per thread, each one also feeding ``metrics``.
+
+    ``span(name, **attributes)`` times a block; spans opened inside it on the
+    same thread become its children. Finished top-level spans are kept in
+    ``recent`` and, if ``trace_file`` is set, appended to it as OTLP/JSON
+    lines that an OpenTelemetry collector can ingest.
+    """
+
+    def __init__(self, metrics=None, keep=50, trace_file=None):
+        self.metrics = metrics or Metrics()
+        self.recent = deque(maxlen=keep)
+        self.trace_file = trace_file
+        self._local = threading.local()
+        self._file_lock = threading.Lock()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def current(self):
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        span = self.start(name, **attributes)
+        try:
+            yield span
+        except Exception as error:
+            span.status = 'error'
+            span.attributes.setdefault('error', type(error).__name__)
+            raise
+        finally:
+            self.end(span)
+
+    def start(self, name, root=False, **attributes):
+        # root=True starts a new trace even if an older one was left open on this thread
+        stack = self._stack()
+        if root:
+            stack.clear()
+        parent = stack[-1] if stack else None
+        span = Span(name, parent, attributes)
+        if parent:
+            parent.children.append(span)
+        stack.append(span)
+        return span
+
+    def end(self, span):
+        if span.seconds is not None:
+            return
+        span.seconds = time.perf_counter() - span._start
+        stack = self._stack()
+        if span in stack:
+            # Children that were never ended are dropped along with it
+            del stack[stack.index(span):]
+        self._record(span)
+        if span.parent is None:
+            self.recent.append(span)
+            if self.trace_file:
+                self._export(span)
+
+    def _record(self, span):
+        name, attributes = span.name, span.attributes
+        self.metrics.observe('poeticapic_stage_seconds', span.seconds, stage=name)
+        self.metrics.inc('poeticapic_stage_total', stage=name, status=span.status)
+        if 'cache_hit' in attributes:
+            self.metrics.inc('poeticapic_cache_lookups_total', stage=name,
+                             result='hit' if attributes['cache_hit'] else 'miss')
+        if 'grpc_code' in attributes:
+            self.metrics.inc('poeticapic_grpc_requests_total', workflow=attributes.get('workflow', ''),
+                             code=attributes['grpc_code'])
+        for key in ('bytes_in', 'bytes_out'):
+            if key in attributes:
+                self.metrics.inc(f'poeticapic_stage_{key}_total', attributes[key], stage=name)
+
+    @staticmethod
+    def to_otlp(root, service_name='poeticapic'):
+        """One trace as an OTLP/JSON ExportTraceServiceRequest."""
+        spans = []
+        for _, span in root.walk():
+            spans.append({
+                'traceId': span.trace_id,
+                'spanId': span.span_id,
+                'parentSpanId': span.parent.span_id if span.parent else '',
+                'name': span.name,
+                'kind': 1,
+                'startTimeUnixNano': str(span.start_ns),
+                'endTimeUnixNano': str(span.start_ns + int((span.seconds or 0) * 1e9)),
+                'attributes': [_otlp_attribute(key, value) for key, value in span.attributes.items()],
+                'status': {'code': 2 if span.status == 'error' else 1},
+            })
+        return {'resourceSpans': [{
+            'resource': {'attributes': [_otlp_attribute('service.name', service_name)]},
+            'scopeSpans': [{'scope': {'name': service_name}, 'spans': spans}],
+        }]}
+
+    def _export(self, root):
+        line = json.dumps(self.to_otlp(root))
+        with self._file_lock, open(self.trace_file, 'a') as f:
+            f.write(line + "\n")
+
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = tracer.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+_metrics_server = None
+_server_lock = threading.Lock()
+
+
+def serve_metrics(port):
+    """Expose ``tracer.metrics`` for Prometheus to scrape; safe to call on every rerun."""
+    global _metrics_server
+    with _server_lock:
+        if _metrics_server is None:
+            _metrics_server = ThreadingHTTPServer(('', port), _MetricsHandler)
+            threading.Thread(target=_metrics_server.serve_forever, daemon=True).start()
+    return _metrics_server
+
+
+# One per process, shared by every session and the background workers
+tracer = Tracer(trace_file=os.getenv("TRACE_FILE"))
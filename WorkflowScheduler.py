@@ -0,0 +1,294 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import CancelledError, Future, InvalidStateError, ThreadPoolExecutor
+
+from Tracer import tracer
+
+# Per workflow; set CLARIFAI_REQUESTS_PER_SECOND=0 to turn the limit off
+REQUESTS_PER_SECOND = float(os.getenv("CLARIFAI_REQUESTS_PER_SECOND", 10))
+BURST = int(os.getenv("CLARIFAI_BURST", 10))
+# PostWorkflowResults accepts up to 128 inputs; batches of queued tagging inputs stay well below that
+MAX_BATCH_INPUTS = 32
+# How long the oldest queued tagging input waits for others to share its request
+BATCH_WINDOW_SECONDS = 0.02
+MAX_IN_FLIGHT = 16
+
+
+class TokenBucket:
+    """``rate`` calls per second on average, with bursts of up to ``burst`` calls."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # Takes a token now, possibly going into debt; returns the seconds to wait before using it
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+class _Item:
+    # One workflow input, shared by every caller that asked for it while it was pending
+    def __init__(self, key, workflow_input, session):
+        self.key = key
+        self.input = workflow_input
+        self.session = session
+        self.waiters = []
+        self.queued_at = time.perf_counter()
+        self.wait_seconds = 0.0
+
+
+class _Lane:
+    # Inputs waiting for one (client, credentials, app, workflow), queued per session
+    def __init__(self, client, metadata, template, idempotent, max_batch, window):
+        self.client = client
+        self.metadata = metadata
+        self.template = template
+        self.idempotent = idempotent
+        self.max_batch = max_batch
+        self.window = window
+        self.sessions = OrderedDict()
+        self.queued = 0
+        self.dispatching = False
+
+    def push(self, item):
+        self.sessions.setdefault(item.session, deque()).append(item)
+        self.queued += 1
+
+    def oldest(self):
+        return min(queue[0].queued_at for queue in self.sessions.values())
+
+    def take(self, limit):
+        # Round robin: one input per session in turn, so a big batch job can't starve interactive users
+        items = []
+        while self.sessions and len(items) < limit:
+            session, queue = next(iter(self.sessions.items()))
+            items.append(queue.popleft())
+            del self.sessions[session]
+            if queue:
+                self.sessions[session] = queue
+        self.queued -= len(items)
+        return items
+
+
+class WorkflowScheduler:
+    """Client-side queue in front of PostWorkflowResults, shared by every session in the process.
+
+    Inputs identical to one already pending (same workflow, same bytes) are
+    coalesced: they wait for that input's result instead of being sent again.
+    Every workflow is held to a token bucket of ``rate`` requests per second.
+    Inputs of ``batched_workflows`` queued within ``batch_window`` of each other
+    are sent as one multi-input request of up to ``max_batch`` inputs. Queues
+    are kept per session and served round robin. Queue depth, wait time,
+    coalesced inputs and batch sizes are reported through ``tracer.metrics``.
+    """
+
+    def __init__(self, rate=REQUESTS_PER_SECOND, burst=BURST, batched_workflows=(), max_batch=MAX_BATCH_INPUTS,
+                 batch_window=BATCH_WINDOW_SECONDS, max_in_flight=MAX_IN_FLIGHT):
+        self.rate = rate
+        self.burst = burst
+        self.batched_workflows = set(batched_workflows)
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._lanes = {}
+        self._pending = {}
+        self._buckets = {}
+        self._stats = {}
+        self._senders = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="clarifai-send")
+
+    def submit(self, client, request, metadata=(), session=None, token=None, idempotent=False):
+        """Send ``request`` through ``client`` and return a response holding just its inputs' results.
+
+        Raises grpc.RpcError like ``ClarifaiClient.call``, and grpc.FutureCancelledError
+        once ``token`` is cancelled. A cancel only stops this caller waiting; the shared
+        request is skipped if nobody is waiting for it by the time its turn comes.
+        ``idempotent`` is passed on to ``ClarifaiClient.call``.
+        """
+        # Imported on first use, so creating the process-wide scheduler at startup stays cheap
+        import grpc
+        from clarifai_grpc.grpc.api import service_pb2
+
+        workflow = request.workflow_id
+        template = service_pb2.PostWorkflowResultsRequest()
+        template.CopyFrom(request)
+        del template.inputs[:]
+        lane_key = (client, tuple(metadata), template.SerializeToString(deterministic=True), idempotent)
+
+        waiters = []
+        with self._ready:
+            lane = self._lanes.get(lane_key)
+            if lane is None:
+                batched = workflow in self.batched_workflows
+                lane = self._lanes[lane_key] = _Lane(client, tuple(metadata), template, idempotent,
+                                                     self.max_batch if batched else 1,
+                                                     self.batch_window if batched else 0.0)
+            coalesced = 0
+            for workflow_input in request.inputs:
+                key = (lane_key, hashlib.sha256(workflow_input.SerializeToString(deterministic=True)).digest())
+                item = self._pending.get(key)
+                if item is None:
+                    item = self._pending[key] = _Item(key, workflow_input, session)
+                    lane.push(item)
+                else:
+                    coalesced += 1
+                waiter = Future()
+                item.waiters.append(waiter)
+                waiters.append((item, waiter))
+            tracer.metrics.set('poeticapic_clarifai_queue_depth', lane.queued, workflow=workflow)
+            if not lane.dispatching:
+                lane.dispatching = True
+                threading.Thread(target=self._dispatch, args=(lane_key, lane), daemon=True,
+                                 name="clarifai-dispatch").start()
+            self._ready.notify_all()
+        self._count(workflow, coalesced=coalesced)
+
+        outcomes = []
+        for item, waiter in waiters:
+            if token:
+                token.attach(waiter)
+            try:
+                outcomes.append(waiter.result())
+            except CancelledError:
+                raise grpc.FutureCancelledError()
+
+        span = tracer.current()
+        if span:
+            wait_seconds = max((item.wait_seconds for item, _ in waiters), default=0.0)
+            span.set(coalesced_inputs=coalesced, queue_seconds=round(wait_seconds, 4))
+        return self._response(outcomes)
+
+    @staticmethod
+    def _response(outcomes):
+        # One result per input, each with its own status, summed up like the API does: SUCCESS, MIXED_STATUS,
+        # or the first failure when none of them worked
+        from clarifai_grpc.grpc.api import resources_pb2, service_pb2
+        from clarifai_grpc.grpc.api.status import status_code_pb2
+
+        response = service_pb2.PostWorkflowResultsResponse()
+        failures = []
+        for status, result in outcomes:
+            if status.code != status_code_pb2.SUCCESS:
+                failures.append(status)
+            response.results.append(result if result is not None else resources_pb2.WorkflowResult(status=status))
+        if not failures:
+            response.status.code = status_code_pb2.SUCCESS
+        elif len(failures) < len(outcomes):
+            response.status.code = status_code_pb2.MIXED_STATUS
+        else:
+            response.status.CopyFrom(failures[0])
+        return response
+
+    def _dispatch(self, lane_key, lane):
+        workflow = lane.template.workflow_id
+        while True:
+            with self._ready:
+                while lane.queued and lane.queued < lane.max_batch:
+                    remaining = lane.oldest() + lane.window - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._ready.wait(remaining)
+                if not lane.queued:
+                    lane.dispatching = False
+                    del self._lanes[lane_key]
+                    return
+
+            # Throttled inputs keep queueing meanwhile, so the next batch is fuller
+            delay = self._bucket(workflow).reserve() if self.rate else 0.0
+            if delay:
+                time.sleep(delay)
+
+            with self._ready:
+                items = []
+                for item in lane.take(lane.max_batch):
+                    if all(waiter.cancelled() for waiter in item.waiters):
+                        del self._pending[item.key]
+                    else:
+                        items.append(item)
+                tracer.metrics.set('poeticapic_clarifai_queue_depth', lane.queued, workflow=workflow)
+            now = time.perf_counter()
+            for item in items:
+                item.wait_seconds = now - item.queued_at
+                tracer.metrics.observe('poeticapic_clarifai_queue_seconds', item.wait_seconds, workflow=workflow)
+            if items:
+                self._count(workflow, batches=1, inputs=len(items))
+                self._senders.submit(self._send, lane, items)
+
+    def _bucket(self, workflow):
+        with self._lock:
+            if workflow not in self._buckets:
+                self._buckets[workflow] = TokenBucket(self.rate, self.burst)
+            return self._buckets[workflow]
+
+    def _send(self, lane, items):
+        from clarifai_grpc.grpc.api import service_pb2
+        from clarifai_grpc.grpc.api.status import status_code_pb2, status_pb2
+
+        request = service_pb2.PostWorkflowResultsRequest()
+        request.CopyFrom(lane.template)
+        request.inputs.extend(item.input for item in items)
+        try:
+            response = lane.client.call('PostWorkflowResults', request, lane.metadata, idempotent=lane.idempotent)
+            if response.results:
+                # Results come back in input order, each with its own status: in a MIXED_STATUS answer,
+                # one session's bad image must not fail the other inputs batched with it
+                outcomes = [self._outcome(response.status, result) for result in response.results]
+                missing = status_pb2.Status(code=status_code_pb2.FAILURE, description="no result for this input")
+                outcomes += [(missing, None)] * (len(items) - len(outcomes))
+            else:
+                outcomes = [(response.status, None)] * len(items)
+            error = None
+        except Exception as exception:
+            outcomes, error = [None] * len(items), exception
+
+        with self._lock:
+            # No new caller can join these items once they leave _pending
+            for item in items:
+                del self._pending[item.key]
+        for item, outcome in zip(items, outcomes):
+            for waiter in item.waiters:
+                try:
+                    if error:
+                        waiter.set_exception(error)
+                    else:
+                        waiter.set_result(outcome)
+                except InvalidStateError:
+                    pass  # cancelled by its caller
+
+    @staticmethod
+    def _outcome(status, result):
+        # A result without a status of its own shares the request's
+        if result.HasField('status'):
+            return result.status, result
+        outcome = type(result)()
+        outcome.CopyFrom(result)
+        outcome.status.CopyFrom(status)
+        return status, outcome
+
+    def _count(self, workflow, **counts):
+        with self._lock:
+            stats = self._stats.setdefault(workflow, {'coalesced': 0, 'batches': 0, 'inputs': 0})
+            for name, value in counts.items():
+                stats[name] += value
+        for name, value in counts.items():
+            if value:
+                tracer.metrics.inc(f'poeticapic_clarifai_{name}_total', value, workflow=workflow)
+
+    def stats(self):
+        """Per workflow: inputs queued now, plus coalesced inputs, requests sent and inputs sent so far."""
+        with self._lock:
+            stats = {workflow: dict(counts, queued=0) for workflow, counts in self._stats.items()}
+            for lane in self._lanes.values():
+                stats.setdefault(lane.template.workflow_id, {})['queued'] = lane.queued
+        return stats
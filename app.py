@@ -1,14 +1,23 @@
 ## python -m streamlit run final_code.py
 
 import streamlit as st
-from PIL import Image, ImageFilter, ImageDraw, ImageFont, ImageOps, ImageEnhance
-from clarifai_grpc.grpc.api import resources_pb2, service_pb2, service_pb2_grpc
-from clarifai_grpc.grpc.api.status import status_code_pb2
-from clarifai_grpc.channel.clarifai_channel import ClarifaiChannel
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from PIL import Image, ImageFilter, ImageDraw
+# grpc and the clarifai_grpc protobuf modules (~50 ms) are imported by ClarifaiAPI on first use, and
+# ImageBorder (which loads numpy) on the first render, so the first page is painted without them
+import io
 import os
-import textwrap
+import threading
+import time
 from dotenv import load_dotenv
-from ImageBorder import ImageBorder
+from ColorFilter import ColorFilter
+from RenderCache import RenderCache
+from ResultCache import ResultCache
+from ImageStore import ImageStore
+from TextLayout import TextLayout, LINE_SPACING
+from GenerationJob import GenerationJob, run_in_background
+from Tracer import tracer, serve_metrics
+from WorkflowScheduler import WorkflowScheduler
 import re
 
 # Load environment variables
@@ -20,154 +29,514 @@ PAT = os.getenv("PAT")
 APP_ID = "my-first-application-ryesqk"
 WORKFLOW_ID_IMAGE = os.getenv("WORKFLOW_ID_IMAGE")
 WORKFLOW_ID_TEXT = os.getenv("WORKFLOW_ID_TEXT")
-metadata = (('authorization', 'Key ' + PAT),)
+# Without a PAT the app still starts; API calls then fail with a message instead
+metadata = (('authorization', 'Key ' + PAT),) if PAT else ()
+RENDER_CACHE_BYTES = 256 * 1024 * 1024
+# The tagging model sees small inputs anyway, so a smaller upload loses nothing
+TAG_IMAGE_MAX_SIDE = 512
+TAG_JPEG_QUALITY = 85
+# Used to estimate the transfer time saved by shrinking uploads (~8 Mbit/s uplink)
+UPLINK_BYTES_PER_SECOND = float(os.getenv("UPLINK_BYTES_PER_SECOND", 1_000_000))
+
+# Sidebar choices, shared by the single-image and batch modes
+FILTER_OPTIONS = ('Original', 'BLUR', 'CONTOUR', 'DETAIL', 'EDGE_ENHANCE', 'EDGE_ENHANCE_MORE',
+                  'EMBOSS', 'SHARPEN', 'SMOOTH', 'SMOOTH_MORE', 'GAUSSIAN_BLUR', 'MEDIAN_FILTER', 'MAX_FILTER', 'MIN_FILTER','SEPIA','GRAYSCALE','POP ART',
+                  'WARM', 'COOL', 'VINTAGE', 'HIGH CONTRAST')
+TEXT_OPTIONS = ('Life Quote', 'Inspirational Quote','Funny Quote','Love Quote','Birthday Quote','Friendship Quote', 'Two Line Poetry')
+TEXT_POSITIONS = ('Top Left', 'Top Right', 'Top Center','Bottom Left', 'Bottom Right','Bottom Center' ,'Center')
+# Display name -> (Pillow format, file extension, MIME type)
+OUTPUT_FORMATS = {
+    'JPEG': ('JPEG', 'jpg', 'image/jpeg'),
+    'WebP': ('WEBP', 'webp', 'image/webp'),
+    'PNG': ('PNG', 'png', 'image/png'),
+}
+# Set to a directory to keep content-addressed copies of uploads and results on disk
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR")
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", "poeticapic_cache.sqlite3")
+# Filters whose working copies would exceed this run in horizontal strips instead of on the whole image
+RENDER_MEMORY_BUDGET = int(os.getenv("RENDER_MEMORY_BUDGET", 256 * 1024 * 1024))
+# Decompression-bomb guard: bigger JPEGs are decoded at reduced scale, anything else is rejected
+MAX_DECODED_PIXELS = int(os.getenv("MAX_DECODED_PIXELS", 50_000_000))
+# Larger outputs are saved as progressive JPEGs, which browsers show coarse-to-fine while downloading
+PROGRESSIVE_MIN_PIXELS = 1_000_000
+# Set to serve Prometheus metrics on this port; TRACE_FILE (see Tracer.py) writes OTLP/JSON traces
+METRICS_PORT = os.getenv("METRICS_PORT")
+# How long warm_up waits for the Clarifai connection; if it isn't up by then, the first call finishes the job
+WARM_UP_CONNECT_TIMEOUT = 5.0
+
+if __name__ == "__main__":
+    # `streamlit run app.py` executes this file afresh on every rerun; share the imported module's objects
+    # instead of opening another SQLite connection and starting more scheduler threads each time
+    from app import render_cache, result_cache, image_store, workflow_scheduler
+else:
+    # Survives Streamlit reruns because the module is only imported once per process
+    render_cache = RenderCache(RENDER_CACHE_BYTES)
+    # Tags and generated text; on disk, so paid API results also survive restarts
+    result_cache = ResultCache(RESULT_CACHE_PATH)
+    image_store = ImageStore(IMAGE_STORE_DIR) if IMAGE_STORE_DIR else None
+    # Coalesces, rate-limits and (for tagging) batches the workflow calls of every session
+    workflow_scheduler = WorkflowScheduler(batched_workflows={WORKFLOW_ID_IMAGE})
+    if METRICS_PORT:
+        serve_metrics(int(METRICS_PORT))
+
+def border_table():
+    # Name -> BorderSpec; ImageBorder is imported here rather than at startup
+    from ImageBorder import BORDERS
+    return BORDERS
+
+
+class RenderPipeline:
+    """The ordered render steps for one upload, checked before any pixel is decoded.
+
+    Steps are tuples: ``('draft', w, h)``, ``('resize', w, h[, reducing_gap])``,
+    ``('filter', option)`` and ``('border', name, seed, text)``. An unknown step, filter
+    or border, a draft after decoding or a border before the last step raises
+    ValueError here rather than halfway through a render. ``output_size`` is the
+    final canvas size, borders included.
+    """
+
+    def __init__(self, steps, source_size):
+        self.steps = tuple(steps)
+        self.output_size = self._validate(source_size)
+
+    def _validate(self, size):
+        for i, (name, *args) in enumerate(self.steps):
+            if name == 'draft':
+                if i != 0:
+                    raise ValueError("draft only works as the first step, before the image is decoded")
+            elif name == 'resize':
+                if args[0] < 1 or args[1] < 1:
+                    raise ValueError(f"cannot resize to {args[0]}x{args[1]}")
+                size = (args[0], args[1])
+            elif name == 'filter':
+                if args[0] not in ImageProcessor.FILTERS and args[0] not in ColorFilter.PRESETS:
+                    raise ValueError(f"unknown filter {args[0]!r}")
+            elif name == 'border':
+                borders = border_table()
+                if args[0] not in borders:
+                    raise ValueError(f"unknown border {args[0]!r}")
+                if i != len(self.steps) - 1:
+                    raise ValueError("the border has to be the last step")
+                size = borders[args[0]].size(size)
+            else:
+                raise ValueError(f"unknown render step {name!r}")
+        return size
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def __len__(self):
+        return len(self.steps)
+
 
 class ImageProcessor:
     def __init__(self, image):
         self.image = image
 
-    def apply_filter(self, filter_option):
-        filters = {
-            'BLUR': ImageFilter.BLUR,
-            'CONTOUR': ImageFilter.CONTOUR,
-            'EMBOSS': ImageFilter.EMBOSS,
-            'FIND_EDGES': ImageFilter.FIND_EDGES,
-            'SHARPEN': ImageFilter.SHARPEN,
-            'SMOOTH': ImageFilter.SMOOTH,
-            'DETAIL': ImageFilter.DETAIL,
-            'EDGE_ENHANCE': ImageFilter.EDGE_ENHANCE,
-            'EDGE_ENHANCE_MORE': ImageFilter.EDGE_ENHANCE_MORE,
-            'GAUSSIAN_BLUR': ImageFilter.GaussianBlur(radius=2),
-            'MEDIAN_FILTER': ImageFilter.MedianFilter(size=3),
-            'MAX_FILTER': ImageFilter.MaxFilter(size=3),
-            'MIN_FILTER': ImageFilter.MinFilter(size=3),
-            'SEPIA': 'SEPIA',
-            'GRAYSCALE': 'GRAYSCALE',
-            'POP ART' : 'POP ART'
-        }
+    # Neighbourhood filters; everything else (colour presets, 'Original') works per pixel
+    FILTERS = {
+        'BLUR': ImageFilter.BLUR,
+        'CONTOUR': ImageFilter.CONTOUR,
+        'EMBOSS': ImageFilter.EMBOSS,
+        'FIND_EDGES': ImageFilter.FIND_EDGES,
+        'SHARPEN': ImageFilter.SHARPEN,
+        'SMOOTH': ImageFilter.SMOOTH,
+        'SMOOTH_MORE': ImageFilter.SMOOTH_MORE,
+        'DETAIL': ImageFilter.DETAIL,
+        'EDGE_ENHANCE': ImageFilter.EDGE_ENHANCE,
+        'EDGE_ENHANCE_MORE': ImageFilter.EDGE_ENHANCE_MORE,
+        'GAUSSIAN_BLUR': ImageFilter.GaussianBlur(radius=2),
+        'MEDIAN_FILTER': ImageFilter.MedianFilter(size=3),
+        'MAX_FILTER': ImageFilter.MaxFilter(size=3),
+        'MIN_FILTER': ImageFilter.MinFilter(size=3),
+    }
+
+    # Resampling shortcut for previews: reduce() by an integer factor first, then resample
+    PREVIEW_REDUCING_GAP = 2.0
+
+    memory_budget = RENDER_MEMORY_BUDGET
+
+    @staticmethod
+    def open(source, max_pixels=MAX_DECODED_PIXELS):
+        """Image.open (bytes, path or file) with a decompression-bomb guard that only reads the header.
+
+        JPEGs over ``max_pixels`` are set to decode at 1/2, 1/4 or 1/8 scale, so the
+        full-size pixels never exist in memory; other formats that large are rejected
+        with ``Image.DecompressionBombError``. Pillow's process-wide
+        ``Image.MAX_IMAGE_PIXELS`` check is left as it is and stays the hard ceiling.
+        """
+        image = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+        pixels = image.width * image.height
+        if pixels <= max_pixels:
+            return image
+        if image.format == 'JPEG':
+            for scale in (2, 4, 8):
+                if pixels / scale ** 2 <= max_pixels:
+                    image.draft('RGB', (-(-image.width // scale), -(-image.height // scale)))
+                    return image
+        raise Image.DecompressionBombError(
+            f"{image.width}x{image.height} is too large to process (limit {max_pixels:,} pixels)")
+
+    def apply_filter(self, filter_option, in_place=False):
+        # in_place: nothing else holds self.image (e.g. it was just decoded), so tiles may overwrite it
+        if filter_option in ColorFilter.PRESETS:
+            apply, halo = (lambda img: ColorFilter.apply(img, filter_option)), 0
+        elif filter_option in self.FILTERS:
+            image_filter = self.FILTERS[filter_option]
+            apply, halo = (lambda img: img.filter(image_filter)), self.halo(image_filter)
+        else:
+            return
 
-        if filter_option in filters:
-            if filter_option == 'SEPIA':
-                img = self.image.convert("RGB")
-                pixels = img.getdata()
-                new_pixels = []
-                for pixel in pixels:
-                    r, g, b = pixel
-                    tr = int(0.393 * r + 0.769 * g + 0.189 * b)
-                    tg = int(0.349 * r + 0.686 * g + 0.168 * b)
-                    tb = int(0.272 * r + 0.534 * g + 0.131 * b)
-                    new_pixels.append((tr, tg, tb))
-                img.putdata(new_pixels)
-                self.image = img
-
-            elif filter_option == 'POP ART':
-                pop_art = self.image.convert("RGB")
-                enhancer = ImageEnhance.Color(pop_art)
-                pop_art = enhancer.enhance(4.0) 
-                self.image = pop_art
-            elif filter_option == 'GRAYSCALE':
-                grayscale = ImageOps.grayscale(self.image)
-                self.image = grayscale.convert("RGB")
-                
-            else:
-                self.image = self.image.filter(filters[filter_option])
+        # Whole-image filtering holds the input, the output and (for rank filters) a padded copy
+        if self.image.width * self.image.height * 4 * 3 > self.memory_budget:
+            self._filter_tiled(apply, halo, in_place)
+        else:
+            self.image = apply(self.image)
+
+    @staticmethod
+    def halo(image_filter):
+        """Rows of context each side of a tile needs for ``image_filter`` to match the whole-image result."""
+        if isinstance(image_filter, ImageFilter.RankFilter):
+            return image_filter.size // 2
+        if isinstance(image_filter, ImageFilter.GaussianBlur):
+            radius = image_filter.radius
+            # Three box blurs approximate the gaussian; their combined reach is about 3 * radius
+            return int(3 * (max(radius) if isinstance(radius, (tuple, list)) else radius)) + 2
+        return max(image_filter.filterargs[0]) // 2
+
+    def _filter_tiled(self, apply, halo, in_place=False):
+        # Full-width strips, so only the top and bottom of each strip need halo rows and
+        # the left/right edges behave exactly as in the whole-image filter
+        source = self.image
+        width, height = source.size
+        # A strip passes through ~5 copies (crop, padded, filter scratch, result, interior), so keep each small
+        rows = max(2 * halo + 1, self.memory_budget // 32 // (width * 4))
+        output = above = None
+        for top in range(0, height, rows):
+            bottom = min(top + rows, height)
+            strip = source.crop((0, top, width, min(height, bottom + halo)))
+            offset = 0
+            if above is not None:
+                # Original rows just above the strip; in place, the source already holds filtered ones there
+                padded = Image.new(strip.mode, (width, above.height + strip.height))
+                padded.paste(above, (0, 0))
+                padded.paste(strip, (0, above.height))
+                strip, offset = padded, above.height
+            result = apply(strip).crop((0, offset, width, offset + bottom - top))
+
+            if output is None:
+                output = source if in_place and result.mode == source.mode else Image.new(result.mode, source.size)
+            if halo:
+                above = source.crop((0, max(0, bottom - halo), width, bottom))
+            output.paste(result, (0, top))
+        self.image = output
     
-    def apply_border(self, border_type, text=None):
-        if border_type == 'Polaroids':
-            self.image = ImageBorder.basic_polaroid(self.image)
-        elif border_type == 'Vintage Frame':
-            self.image = ImageBorder.vintage_frame(self.image)
-        elif border_type == 'Wooden Frame':
-            self.image = ImageBorder.wooden_frame(self.image)
-        elif border_type == 'Bohemian Bliss Frame':
-            self.image = ImageBorder.bohemian_bliss_frame(self.image)
-        elif border_type == 'Filmstrip Border':
-            self.image = ImageBorder.filmstrip_border(self.image, text)
-        elif border_type == 'Grunge Border':
-            self.image = ImageBorder.grunge_border(self.image, text)
-        elif border_type == 'Pixel Frame':
-            self.image = ImageBorder.pixel_frame(self.image)
-        elif border_type == 'Framed Border':
-            self.image = ImageBorder.framed_border(self.image)
-        elif border_type == 'Cartoon Frame':
-            self.image = ImageBorder. cartoon_frame(self.image)
-        elif border_type == 'Bubble Frame':
-            self.image = ImageBorder. bubble_frame(self.image)
-        elif border_type == 'Glitch Frame':
-            self.image = ImageBorder. glitch_frame(self.image)
-
-
-    def resize(self, width, height):
-        img = self.image.resize((width, height))
+    def apply_border(self, border_type, text=None, seed=None):
+        spec = border_table().get(border_type)
+        if spec:
+            self.image = spec.apply(self.image, text=text, seed=seed)
+
+    def plan(self, filter_option, size, border_type, seed=None, preview=False, border_text=None):
+        """Order the render steps so the expensive ones see as few pixels as possible.
+
+        The full-quality render always filters the source and resizes afterwards:
+        resampling blends pixels, so even per-pixel presets that clip or use curves
+        (POP ART, HIGH CONTRAST, VINTAGE) give a different image the other way round.
+        Preview mode, which only has to look right, filters the downscaled image
+        instead and decodes JPEGs at reduced scale with ``draft``. 'Original' adds
+        no filter step. ``border_text`` is the caption of borders that take one.
+        """
+        width, height = size
+        downscale = width * height < self.image.width * self.image.height
+        steps = []
+        if preview and downscale and self.image.format == 'JPEG':
+            steps.append(('draft', width, height))
+
+        resize = ('resize', width, height, self.PREVIEW_REDUCING_GAP) if preview else ('resize', width, height)
+        filters = [('filter', filter_option)] if filter_option != 'Original' else []
+        if downscale and preview:
+            steps += [resize] + filters
+        else:
+            steps += filters + [resize]
+
+        if border_type != 'Original':
+            # Borders without a caption get the same step, and so the same cache keys, whatever the text
+            spec = border_table().get(border_type)
+            text = (border_text or None) if spec and 'text' in spec.params else None
+            steps.append(('border', border_type, seed, text))
+        return RenderPipeline(steps, self.image.size)
+
+    def run_step(self, step):
+        name, *args = step
+        if name == 'draft':
+            self.draft(*args)
+        elif name == 'filter':
+            self.apply_filter(*args)
+        elif name == 'resize':
+            self.resize(*args)
+        elif name == 'border':
+            border_type, seed, text = args
+            self.apply_border(border_type, text=text, seed=seed)
+
+    def apply_pipeline(self, image_hash, filter_option, size, border_type, seed=None, preview=False,
+                       cache=render_cache, border_text=None):
+        # Each step is cached under the upload hash plus every step before it
+        pipeline = self.plan(filter_option, size, border_type, seed, preview, border_text)
+        key = (image_hash,)
+        for step in pipeline:
+            key += (step,)
+            with tracer.span(step[0], step=repr(step[1:]), cache_hit=True) as span:
+                if step[0] == 'border':
+                    # Allocates the output canvas once and pastes the previous stage straight into its
+                    # interior. Never cached: it is cheap, and this render then owns the result outright.
+                    self.image = self._run(step, span)
+                else:
+                    # _run marks the span as a miss when the step actually has to be computed
+                    self.image = cache.stage(key, lambda: self._run(step, span))
+                span.set(width=self.image.width, height=self.image.height)
+
+        if not pipeline.steps or pipeline.steps[-1][0] != 'border':
+            # Cached images are shared between reruns, so later in-place drawing gets its own copy
+            self.image = self.image.copy()
+
+    def _run(self, step, span=None):
+        if span:
+            span.set(cache_hit=False, input_width=self.image.width, input_height=self.image.height)
+        decoded = step[0] != 'draft' and bool(getattr(self.image, 'tile', None))
+        if decoded:
+            # Still lazily opened: time the decode on its own instead of inside the first step
+            with tracer.span('decode', format=self.image.format, width=self.image.width, height=self.image.height):
+                self.image.load()
+        processor = ImageProcessor(self.image)
+        if step[0] == 'filter':
+            # A freshly decoded image isn't in the render cache yet, so a tiled filter may reuse its memory
+            processor.apply_filter(step[1], in_place=decoded)
+        else:
+            processor.run_step(step)
+        return processor.image
+
+    def draft(self, width, height):
+        # JPEG decode-time downscale by 1/2, 1/4 or 1/8, never below the requested size.
+        # Only takes effect before the image is loaded, so it must be the first step.
+        self.image.draft('RGB', (width, height))
+        self.image.load()
+
+    def resize(self, width, height, reducing_gap=None):
+        img = self.image.resize((width, height), reducing_gap=reducing_gap)
         self.image = img
 
-    def add_text(self, text, position_option, font_color, bg_color=None, font_size=20):
+    def add_text(self, text, position_option, font_color, bg_color=None, font_size=20, auto_fit=False):
+        with tracer.span('text', characters=len(text), width=self.image.width, height=self.image.height):
+            self._add_text(text, position_option, font_color, bg_color, font_size, auto_fit)
+
+    def _add_text(self, text, position_option, font_color, bg_color, font_size, auto_fit):
+        margin = 10
+        max_width = self.image.width - 2 * margin
+        if auto_fit:
+            # Largest size up to font_size that keeps the text within a third of the image
+            font_size = TextLayout.fit(text, max_width, self.image.height // 3, max_size=font_size)
+        layout = TextLayout.layout(text, font_size, max_width)
         draw = ImageDraw.Draw(self.image)
-        try:
-            font = ImageFont.truetype("Arial.ttf", font_size)
-        except IOError:
-            font = ImageFont.load_default()
-            print("Using default font. Font size will not be adjustable.")
-        
-        lines = textwrap.wrap(text, width=60)
-        
-        if 'Center' in position_option:
-            lines = textwrap.wrap(text, width=60)
-            total_text_height = sum([draw.textbbox((0, 0), line, font=font)[3] for line in lines])
-            
-            position_map = {
-                'Top Center': (self.image.width // 2, 10),
-                'Bottom Center': (self.image.width // 2, self.image.height - total_text_height - 10 - 20),
-                'Center': (self.image.width // 2, (self.image.height - total_text_height) // 2)
-            }
-
-            base_x, base_y = position_map[position_option]
-            for line in lines:
-                line_bbox = draw.textbbox((0, 0), line, font=font)
-                line_width = line_bbox[2] - line_bbox[0]
-                line_height = line_bbox[3] - line_bbox[1]
-                x = base_x - (line_width // 2)
-                y = base_y
-                if bg_color:
-                    draw.rectangle([x, y, x + line_width, y + line_height], fill=bg_color)
-                draw.text((x, y), line, fill=font_color, font=font)
-                base_y += line_height
-            lines = textwrap.wrap(text, width=60)
-        
-        else:
-            wrapped_text = "\n".join(lines)
 
-            text_bbox = draw.textbbox((0, 0), wrapped_text, font=font)
-            text_width = text_bbox[2] - text_bbox[0]
-            text_height = text_bbox[3] - text_bbox[1]
+        position_map = {
+            'Top Left': (margin, margin),
+            'Top Right': (self.image.width - layout.width - margin, margin),
+            'Top Center': (self.image.width // 2, margin),
+            'Bottom Left': (margin, self.image.height - layout.height - margin),
+            'Bottom Right': (self.image.width - layout.width - margin, self.image.height - layout.height - margin),
+            'Bottom Center': (self.image.width // 2, self.image.height - layout.height - margin - 20),
+            'Center': (self.image.width // 2, (self.image.height - layout.height) // 2),
+        }
+        base_x, base_y = position_map[position_option]
+        centered = 'Center' in position_option
 
-            position_map = {
-                'Top Left': (10, 10),
-                'Top Right': (self.image.width - text_width - 10, 10),
-                'Bottom Left': (10, self.image.height - text_height - 10),
-                'Bottom Right': (self.image.width - text_width - 10, self.image.height - text_height - 10)
-            }
+        if bg_color and not centered:
+            draw.rectangle([base_x, base_y, base_x + layout.width, base_y + layout.height], fill=bg_color)
 
-            base_x, base_y = position_map[position_option]
+        for line in layout.lines:
+            # Centered text is aligned line by line, the corners as a left-aligned block
+            x = base_x - line.width // 2 - line.bbox[0] if centered else base_x - line.bbox[0]
+            if bg_color and centered:
+                draw.rectangle([x + line.bbox[0], base_y, x + line.bbox[2], base_y + layout.line_height - LINE_SPACING],
+                               fill=bg_color)
+            draw.text((x, base_y), line.text, fill=font_color, font=layout.font)
+            base_y += layout.line_height
 
-            
-            if bg_color:
-                draw.rectangle([base_x, base_y, base_x + text_width, base_y + text_height], fill=bg_color)
-            draw.text((base_x, base_y), wrapped_text, fill=font_color, font=font)
-    
     def save(self, path):
         self.image.save(path)
 
-class ClarifaiAPI:
-    def __init__(self):
-        self.channel = ClarifaiChannel.get_grpc_channel()
-        self.stub = service_pb2_grpc.V2Stub(self.channel)
+    def encode(self, output_format='JPEG', quality=90, progressive=None, optimize=False):
+        """Encode the image in memory, e.g. for st.image and st.download_button.
+
+        ``progressive=None`` picks progressive JPEG for images of PROGRESSIVE_MIN_PIXELS and up.
+        """
+        img = self.image
+        options = {'optimize': optimize}
+        if output_format == 'JPEG':
+            img = img if img.mode in ('RGB', 'L') else img.convert('RGB')
+            if progressive is None:
+                progressive = img.width * img.height >= PROGRESSIVE_MIN_PIXELS
+            options.update(quality=quality, progressive=progressive)
+        elif output_format == 'WEBP':
+            options = {'quality': quality, 'method': 6 if optimize else 4}
+        with tracer.span('encode', format=output_format, width=img.width, height=img.height) as span:
+            buffer = io.BytesIO()
+            img.save(buffer, format=output_format, **options)
+            span.set(bytes_out=buffer.tell())
+        return buffer.getvalue()
 
-    def get_image_tags(self, image_path):
-        with open(image_path, "rb") as f:
-            file_bytes = f.read()
-
-        response = self.stub.PostWorkflowResults(
+class ClarifaiAPI:
+    # Bytes actually sent to the tagging workflow, shared by all sessions
+    upload_metrics = {'requests': 0, 'original_bytes': 0, 'sent_bytes': 0, 'prepare_seconds': 0.0,
+                      'estimated_seconds_saved': 0.0, 'last': None}
+    _metrics_lock = threading.Lock()
+
+    def __init__(self, client=None, cache=result_cache, scheduler=workflow_scheduler, session=None):
+        from ClarifaiClient import ClarifaiClient
+        # Shares one channel per process unless a client is passed in (e.g. one pointed at FakeClarifai)
+        self.client = client or ClarifaiClient.shared()
+        self.stub = self.client.stub
+        # Pass cache=None to always call the API
+        self.cache = cache
+        # Pass scheduler=None to send every call straight away; session is whose queue calls wait in
+        self.scheduler = scheduler
+        self.session = session
+        self.last_error = None
+
+    def post_workflow_results(self, request, token=None):
+        # token (ClarifaiClient.CancelToken) lets a background job cancel the call in flight.
+        # Runs on worker threads too, so a failure returns None and leaves the message in last_error
+        # for the script thread to show; Streamlit calls from here would have no page to draw on.
+        import grpc
+        from clarifai_grpc.grpc.api.status import status_code_pb2
+
+        with tracer.span('clarifai', workflow=request.workflow_id, inputs=len(request.inputs),
+                         bytes_out=request.ByteSize()) as span:
+            if not PAT:
+                span.status = 'error'
+                self.last_error = "Post workflow results failed: PAT is not set (add it to the environment or .env)"
+                return None
+            # Tagging may be retried after a timeout; text generation must not run twice
+            idempotent = request.workflow_id == WORKFLOW_ID_IMAGE
+            try:
+                if self.scheduler:
+                    response = self.scheduler.submit(self.client, request, metadata, self.session, token, idempotent)
+                else:
+                    response = self.client.call('PostWorkflowResults', request, metadata, token=token,
+                                                idempotent=idempotent)
+            except grpc.RpcError as error:
+                span.set(grpc_code=error.code().name)
+                span.status = 'error'
+                self.last_error = "Post workflow results failed, status: " + error.code().name
+                return None
+            span.set(grpc_code='OK', status=status_code_pb2.StatusCode.Name(response.status.code),
+                     bytes_in=response.ByteSize())
+
+            # MIXED_STATUS: some inputs worked; callers check each result's own status
+            if response.status.code not in (status_code_pb2.SUCCESS, status_code_pb2.MIXED_STATUS):
+                span.status = 'error'
+                self.last_error = "Post workflow results failed, status: " + response.status.description
+                return None
+
+        return response
+
+    @staticmethod
+    def shrink_for_upload(image, max_side=TAG_IMAGE_MAX_SIDE, in_place=False):
+        # in_place: the caller just opened image and has no other use for it, so thumbnail() may shrink it
+        # and, while it is still unloaded, decode a JPEG at reduced scale. Otherwise image is left alone.
+        img = image if image.mode == "RGB" else image.convert("RGB")
+        if img is image and not in_place:
+            if max(img.size) <= max_side:
+                return img.copy()
+            # Same size and resampling as thumbnail(), into a new image
+            scale = max_side / max(img.size)
+            size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            return img.resize(size, Image.Resampling.BICUBIC, reducing_gap=2.0)
+        img.thumbnail((max_side, max_side))
+        return img
+
+    @staticmethod
+    def encode_upload(image, quality=TAG_JPEG_QUALITY):
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality)
+        return buffer.getvalue()
+
+    @staticmethod
+    def prepare_upload(image, max_side=TAG_IMAGE_MAX_SIDE, quality=TAG_JPEG_QUALITY, in_place=False):
+        """Downscale to the classifier's input size and re-encode as a small JPEG without EXIF."""
+        return ClarifaiAPI.encode_upload(ClarifaiAPI.shrink_for_upload(image, max_side, in_place), quality)
+
+    @classmethod
+    def _record_upload(cls, original_bytes, sent_bytes, prepare_seconds):
+        saved_seconds = (original_bytes - sent_bytes) / UPLINK_BYTES_PER_SECOND - prepare_seconds
+        with cls._metrics_lock:
+            metrics = cls.upload_metrics
+            metrics['requests'] += 1
+            metrics['original_bytes'] += original_bytes
+            metrics['sent_bytes'] += sent_bytes
+            metrics['prepare_seconds'] += prepare_seconds
+            metrics['estimated_seconds_saved'] += saved_seconds
+            metrics['last'] = {'original_bytes': original_bytes, 'sent_bytes': sent_bytes,
+                               'prepare_seconds': prepare_seconds, 'estimated_seconds_saved': saved_seconds}
+
+    def get_image_tags(self, image, original_bytes=None, image_hash=None, token=None, in_place=False):
+        # in_place: as for shrink_for_upload, image is the caller's to give up and may be shrunk in place
+        with tracer.span('tag', cache_hit=False) as span:
+            return self._get_image_tags(span, image, original_bytes, image_hash, token, in_place)
+
+    def _get_image_tags(self, span, image, original_bytes, image_hash, token, in_place):
+        # Accepts an in-memory PIL image; a file path still works for older callers
+        if isinstance(image, str):
+            original_bytes = os.path.getsize(image)
+            image, in_place = ImageProcessor.open(image), True
+
+        if self.cache and image_hash:
+            tags = self.cache.get_tags(image_hash)
+            if tags is not None:
+                span.set(cache_hit=True)
+                return tags
+
+        start = time.perf_counter()
+        small = self.shrink_for_upload(image, in_place=in_place)
+        phash = None
+        if self.cache:
+            # Near-duplicates of an earlier upload (re-encoded, resized) reuse its tags
+            phash = ResultCache.perceptual_hash(small)
+            tags = self.cache.get_tags(phash=phash)
+            if tags is not None:
+                span.set(cache_hit=True, near_duplicate=True)
+                return tags
+
+        file_bytes = self.encode_upload(small)
+        self._record_upload(original_bytes or len(file_bytes), len(file_bytes), time.perf_counter() - start)
+        span.set(original_bytes=original_bytes or len(file_bytes), upload_bytes=len(file_bytes),
+                 width=small.width, height=small.height)
+
+        tags = self._request_tags([file_bytes], token)[0]
+        if self.cache and tags:
+            self.cache.put_tags(image_hash, tags, phash)
+        return tags
+
+    def get_image_tags_batch(self, uploads, image_hashes=None):
+        """Tags for many prepared uploads (see prepare_upload), sent as one multi-input request."""
+        image_hashes = image_hashes or [None] * len(uploads)
+        with tracer.span('tag_batch', inputs=len(uploads), upload_bytes=sum(map(len, uploads))) as span:
+            tags = [self.cache.get_tags(image_hash) if self.cache and image_hash else None
+                    for image_hash in image_hashes]
+            missing = [i for i, found in enumerate(tags) if found is None]
+            span.set(cache_hits=len(uploads) - len(missing))
+            if missing:
+                for i, found in zip(missing, self._request_tags([uploads[i] for i in missing])):
+                    tags[i] = found
+                    if self.cache and found and image_hashes[i]:
+                        self.cache.put_tags(image_hashes[i], found)
+            return tags
+
+    def _request_tags(self, uploads, token=None):
+        from clarifai_grpc.grpc.api import resources_pb2, service_pb2
+        from clarifai_grpc.grpc.api.status import status_code_pb2
+
+        response = self.post_workflow_results(
             service_pb2.PostWorkflowResultsRequest(
                 user_app_id=resources_pb2.UserAppIDSet(user_id=USER_ID, app_id=APP_ID),
                 workflow_id=WORKFLOW_ID_IMAGE,
@@ -177,19 +546,42 @@ class ClarifaiAPI:
                             image=resources_pb2.Image(base64=file_bytes)
                         )
                     )
+                    for file_bytes in uploads
                 ]
             ),
-            metadata=metadata
+            token
         )
 
-        if response.status.code != status_code_pb2.SUCCESS:
-            st.write("Post workflow results failed, status: " + response.status.description)
-            return []
+        if response is None:
+            return [[] for _ in uploads]
+
+        # Results come back in input order; one rejected image only loses its own tags
+        tags = []
+        for result in response.results:
+            if result.HasField('status') and result.status.code != status_code_pb2.SUCCESS:
+                self.last_error = "Tagging an image failed, status: " + result.status.description
+                tags.append([])
+            else:
+                tags.append([concept.name for concept in result.outputs[0].data.concepts] if result.outputs else [])
+        return tags + [[] for _ in range(len(uploads) - len(tags))]
+
+    def get_text(self, raw_text, token=None):
+        with tracer.span('generate', cache_hit=False, prompt_characters=len(raw_text)) as span:
+            if self.cache:
+                text_data = self.cache.get_text(raw_text)
+                if text_data is not None:
+                    span.set(cache_hit=True)
+                    return text_data
+
+            text_data = self._generate_text(raw_text, token)
+            if self.cache and text_data:
+                self.cache.put_text(raw_text, text_data)
+            return text_data
 
-        return [concept.name for concept in response.results[0].outputs[0].data.concepts]
+    def _generate_text(self, raw_text, token=None):
+        from clarifai_grpc.grpc.api import resources_pb2, service_pb2
 
-    def get_text(self, raw_text):
-        response = self.stub.PostWorkflowResults(
+        response = self.post_workflow_results(
             service_pb2.PostWorkflowResultsRequest(
                 user_app_id=resources_pb2.UserAppIDSet(user_id=USER_ID, app_id=APP_ID),
                 workflow_id=WORKFLOW_ID_TEXT,
@@ -201,11 +593,10 @@ class ClarifaiAPI:
                     )
                 ]
             ),
-            metadata=metadata
+            token
         )
 
-        if response.status.code != status_code_pb2.SUCCESS:
-            st.write("Post workflow results failed, status: " + response.status.description)
+        if response is None:
             return ""
 
         text_data = response.results[0].outputs[0].data.text.raw
@@ -224,33 +615,64 @@ class ClarifaiAPI:
         return text_data
     
 
+def session_id():
+    # The Streamlit session running this script, for fair queueing of its API calls
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else None
+
+
+def build_prompt(text_option, tags):
+    tags_str = ' '.join(tags[:2])
+    return f'generate me a tiny {text_option} for "{tags_str} must only be a few words"'
+
+
 def main():
     st.title('PoeticaPic')
     st.write('PoeticaPic is a tool for creating beautiful, unique and stylish images using Poetry and Art.')
     st.sidebar.header('Settings')
 
+    mode = st.sidebar.radio('Mode:', ('Single Image', 'Batch'), horizontal=True)
+    if mode == 'Batch':
+        from batch import batch_page
+        batch_page()
+        return
+
     uploaded_file = st.file_uploader("Choose an image...", type="jpg")
 
     if uploaded_file:
-        image = Image.open(uploaded_file)
+        # Everything this run renders is collected under one trace for the debug panel
+        trace = tracer.start('render', root=True)
+        image_bytes = uploaded_file.getvalue()
+        trace.set(bytes_in=len(image_bytes))
 
-        if not os.path.exists("uploaded_images"):
-            os.makedirs("uploaded_images")
+        def open_upload():
+            # A fresh lazy image per render, since draft() changes the decoder in place
+            return ImageProcessor.open(image_bytes)
 
-        image_name = uploaded_file.name
-        image_name_without_extension = image_name.split(".")[0]
-        image_path = f'uploaded_images/{image_name_without_extension}.jpg'
-        image.save(image_path)
+        try:
+            image = open_upload()
+        except Image.DecompressionBombError as error:
+            tracer.end(trace)
+            st.error(str(error))
+            return
 
-        processor = ImageProcessor(image)
+        image_hash = RenderCache.content_hash(image_bytes)
+        # Stable per upload so random borders don't change on every rerun
+        seed = int(image_hash[:8], 16)
+
+        # Once per upload, not on every rerun of this session
+        if image_store and st.session_state.get('stored_upload') != image_hash:
+            image_store.put(image_bytes, 'jpg')
+            st.session_state['stored_upload'] = image_hash
+
+        processor = ImageProcessor(open_upload())
 
         # Filter Selection in Sidebar
         filter_option = st.sidebar.selectbox(
             'Apply Filter:',
-            ('Original', 'BLUR', 'CONTOUR', 'DETAIL', 'EDGE_ENHANCE', 'EDGE_ENHANCE_MORE',
-             'EMBOSS', 'SHARPEN', 'SMOOTH', 'SMOOTH_MORE', 'GAUSSIAN_BLUR', 'MEDIAN_FILTER', 'MAX_FILTER', 'MIN_FILTER','SEPIA','GRAYSCALE','POP ART')
+            FILTER_OPTIONS,
+            key='filter_option'
         )
-        processor.apply_filter(filter_option)
 
         # Default values for width and height
         default_width = 400
@@ -258,59 +680,165 @@ def main():
 
         width = st.sidebar.slider("Select Image Width:", 100, 800, default_width)
         height = st.sidebar.slider("Select Image Height:", 100, 800, default_height)
-        processor.resize(width, height)
-        
+
 
         border_option = st.sidebar.selectbox(
             'Do You Wanna Apply Border?',
-            ('Original', 'Polaroids',
-             'Vintage Frame', 'Filmstrip Border', 'Grunge Border', 'Framed Border','Glitch Frame' ,'Wooden Frame','Cartoon Frame' , 'Pixel Frame', 'Bubble Frame')
+            ('Original',) + tuple(border_table()),
+            key='border_option'
         )
+        border_spec = border_table().get(border_option)
+        border_text = st.sidebar.text_input('Border Caption:') if border_spec and 'text' in border_spec.params \
+            else None
+        show_gallery = st.sidebar.checkbox('Show Gallery', help='Preview every filter and border side by side')
+
+        processor.apply_pipeline(image_hash, filter_option, (width, height), border_option, seed=seed, preview=True,
+                                 border_text=border_text)
 
-        if border_option != 'Original':
-            processor.apply_border(border_option)
-        
 
         st.image(processor.image, caption='Preview')
+        if show_gallery:
+            from gallery import gallery
+            gallery(image_hash, open_upload, (width, height), filter_option, border_option, seed, border_text)
 
         # Text Options in Sidebar
         st.sidebar.subheader("Text Options")
         text_option = st.sidebar.selectbox(
             'Text Type:',
-            ('Life Quote', 'Inspirational Quote','Funny Quote','Love Quote','Birthday Quote','Friendship Quote', 'Two Line Poetry')
+            TEXT_OPTIONS
         )
         
         text_position = st.sidebar.selectbox(
             'Text Position:',
-            ('Top Left', 'Top Right', 'Top Center','Bottom Left', 'Bottom Right','Bottom Center' ,'Center')
+            TEXT_POSITIONS
         )
         max_font_size = min(image.width, image.height) // 30
         font_size = st.sidebar.slider('Font Size:', 8, max_font_size, 15)
         font_color = st.sidebar.color_picker('Font Color:', '#ffffff')
         bg_color_option = st.sidebar.checkbox('Background Color?')
         bg_color = st.sidebar.color_picker('Background Color:', '#000000') if bg_color_option else None
+        auto_fit = st.sidebar.checkbox('Auto-fit Text Size?', help='Shrink the text until it fits, up to the chosen size')
+
+        st.sidebar.subheader("Output Options")
+        output_option = st.sidebar.selectbox('Output Format:', tuple(OUTPUT_FORMATS))
+        output_format, output_extension, output_mime = OUTPUT_FORMATS[output_option]
+        output_quality = st.sidebar.slider('Quality:', 50, 100, 90) if output_format != 'PNG' else None
+        progressive = st.sidebar.checkbox('Progressive JPEG?') if output_format == 'JPEG' else False
+        optimize = st.sidebar.checkbox('Optimize File Size?', help='Slower to encode, smaller to download')
 
         
 
+        def render_final():
+            # The preview may be approximate; the download is rendered at full quality
+            final = ImageProcessor(open_upload())
+            final.apply_pipeline(image_hash, filter_option, (width, height), border_option, seed=seed,
+                                 border_text=border_text)
+            return final
+
+        job = st.session_state.get('generation_job')
+        if job and job.image_hash != image_hash:
+            # A new upload makes the old generation irrelevant
+            job.cancel()
+            job = None
+
         if st.button('Generate Text & Apply'):
-            api = ClarifaiAPI()
-            tags = api.get_image_tags(image_path)
-            if tags:
-                tags_str = ' '.join(tags[:2])
-                raw_text = f'generate me a tiny {text_option} for "{tags_str} must only be a few words"'
-                generated_text = api.get_text(raw_text)
-                processor.add_text(generated_text, text_position, font_color, bg_color, font_size)
-
-                # Save the modified image
-                modified_image_path = f'uploaded_images/{image_name_without_extension}_modified.jpg'
-                processor.save(modified_image_path)
-
-                st.image(modified_image_path, caption='Final Image')
-                with open(modified_image_path, 'rb') as f:
-                    modified_image_bytes = f.read()
-                st.download_button('Download Modified Image', data=modified_image_bytes, file_name='modified_image.jpg')
-            else:
-                st.error("Failed to generate text. Please try again.")
+            if job:
+                job.cancel()
+            job = GenerationJob.start(ClarifaiAPI(session=session_id()), open_upload(), image_hash,
+                                      lambda tags: build_prompt(text_option, tags), original_bytes=len(image_bytes))
+            st.session_state['generation_job'] = job
+            # Local work doesn't wait for the API: warm the full-quality render while the calls are in flight
+            run_in_background(render_final)
+
+        if job and job.running:
+            generation_progress(job)
+        elif job and job.stage == 'done':
+            processor = render_final()
+            processor.add_text(job.text, text_position, font_color, bg_color, font_size, auto_fit)
+
+            # One encode serves both the display and the download
+            modified_image_bytes = processor.encode(output_format, output_quality, progressive, optimize)
+            if image_store:
+                result_hash = RenderCache.content_hash(modified_image_bytes)
+                if st.session_state.get('stored_result') != result_hash:
+                    image_store.put(modified_image_bytes, output_extension)
+                    st.session_state['stored_result'] = result_hash
+
+            st.image(modified_image_bytes, caption='Final Image')
+            st.download_button('Download Modified Image', data=modified_image_bytes,
+                               file_name=f'modified_image.{output_extension}', mime=output_mime)
+        elif job and job.stage == 'failed':
+            st.error(job.label)
+        elif job and job.stage == 'cancelled':
+            st.info("Generation cancelled.")
+
+        tracer.end(trace)
+        if st.sidebar.checkbox('Show Debug Panel'):
+            debug_panel([trace] + ([job.trace] if job and job.trace and job.trace.seconds is not None else []))
+
+
+def debug_panel(traces):
+    # Where the time of the current render (and its text generation) went
+    st.sidebar.subheader("Debug")
+    for trace in traces:
+        rows = [{'stage': '  ' * depth + span.name, 'ms': round(span.seconds * 1000, 2), 'status': span.status,
+                 'details': ', '.join(f'{key}={value}' for key, value in span.attributes.items())}
+                for depth, span in trace.walk()]
+        st.sidebar.dataframe(rows, hide_index=True)
+    queues = [dict(workflow=workflow, **stats) for workflow, stats in workflow_scheduler.stats().items()]
+    if queues:
+        st.sidebar.dataframe(queues, hide_index=True)
+    with st.sidebar.expander('Prometheus Metrics'):
+        st.code(tracer.metrics.render(), language='text')
+
+
+_warm_up_lock = threading.Lock()
+_warm_up_started = False
+
+
+def warm_up(font_sizes=(15,)):
+    """Pay the one-off costs of the first render and the first API call ahead of time.
+
+    Imports ImageBorder (and numpy), decodes the wood texture, loads the fonts and
+    connects the shared Clarifai channel, importing gRPC and the protobuf modules on
+    the way. Everything it loads is cached per process, so calling it again is cheap.
+    """
+    with tracer.span('warm_up'):
+        from ImageBorder import warm_up as warm_up_borders
+        warm_up_borders()
+        for size in font_sizes:
+            TextLayout.line_height(size)
+        # The request classes ClarifaiAPI builds, and the channel it sends them on
+        from clarifai_grpc.grpc.api import resources_pb2, service_pb2
+        from ClarifaiClient import ClarifaiClient
+        ClarifaiClient.shared().wait_ready(WARM_UP_CONNECT_TIMEOUT)
+
+
+def start_warm_up():
+    # Once per process, in the background; returns the future, or None if it was already started
+    global _warm_up_started
+    with _warm_up_lock:
+        if _warm_up_started:
+            return None
+        _warm_up_started = True
+    return run_in_background(warm_up)
+
+
+@st.fragment(run_every=0.5)
+def generation_progress(job):
+    # Re-runs on its own every half second; the rest of the page is left alone until the job ends
+    if not job.running:
+        st.rerun()
+    st.progress(job.progress, text=job.label)
+    if st.button('Cancel'):
+        job.cancel()
+        st.rerun()
 
 if __name__ == "__main__":
-    main()
+    # `streamlit run app.py` executes this file afresh on every rerun. The imported module is loaded
+    # once per process, so its caches, scheduler and warm-up state survive reruns and are the same
+    # objects batch.py and gallery.py import.
+    import app
+    app.main()
+    # After the first page is out, so the warm-up doesn't hold up its render
+    app.start_warm_up()
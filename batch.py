@@ -0,0 +1,238 @@
+## python batch.py photos/ -o album.zip --filter SEPIA --border Polaroids --text-type "Love Quote"
+
+import argparse
+import io
+import os
+import sys
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import streamlit as st
+
+from app import ClarifaiAPI, ImageProcessor, build_prompt, session_id, FILTER_OPTIONS, TEXT_OPTIONS, TEXT_POSITIONS
+from ImageBorder import BORDERS
+from RenderCache import RenderCache
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# PostWorkflowResults accepts up to 128 inputs; smaller chunks keep the pipeline moving
+TAG_BATCH_SIZE = 32
+API_CONCURRENCY = 4
+
+# Workers render each image once, so keeping intermediates around only costs memory
+_NO_CACHE = RenderCache(0)
+
+
+class BatchSettings:
+    def __init__(self, filter_option='Original', size=(400, 400), border_option='Original',
+                 text_option='Life Quote', text_position='Bottom Center', font_color='#ffffff',
+                 bg_color=None, font_size=15):
+        self.filter_option = filter_option
+        self.size = size
+        self.border_option = border_option
+        self.text_option = text_option
+        self.text_position = text_position
+        self.font_color = font_color
+        self.bg_color = bg_color
+        self.font_size = font_size
+
+
+def read_inputs(source):
+    """Yield (name, bytes) for every image in a directory or ZIP archive (path or file object)."""
+    if not isinstance(source, str) or zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.basename(info.filename), archive.read(info)
+        return
+
+    for name in sorted(os.listdir(source)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            with open(os.path.join(source, name), 'rb') as f:
+                yield name, f.read()
+
+
+def render_job(name, data, settings, with_upload=True):
+    # Runs in a worker process: everything CPU-bound that doesn't need the API results
+    image_hash = RenderCache.content_hash(data)
+    processor = ImageProcessor(ImageProcessor.open(data))
+    processor.apply_pipeline(image_hash, settings.filter_option, settings.size, settings.border_option,
+                             seed=int(image_hash[:8], 16), cache=_NO_CACHE)
+    upload = ClarifaiAPI.prepare_upload(ImageProcessor.open(data), in_place=True) if with_upload else None
+    return name, image_hash, processor.image, upload
+
+
+def _output_name(name):
+    return os.path.splitext(name)[0] + '_poetica.jpg'
+
+
+def run_batch(inputs, settings, output, api=None, workers=None, api_concurrency=API_CONCURRENCY,
+              tag_batch_size=TAG_BATCH_SIZE, progress=None):
+    """Render, tag, caption and ZIP every input; returns throughput stats.
+
+    Rendering runs on a process pool. Tagging sends ``tag_batch_size`` images
+    per request and, like text generation, runs on at most ``api_concurrency``
+    threads. Finished images are streamed into the ZIP at ``output`` (path or
+    writable file object) as soon as their text arrives. An image whose tags or
+    text fail is saved without text and counted in ``without_text``; one that
+    can't be read or rendered is left out and counted in ``skipped``.
+    """
+    api = api or ClarifaiAPI()
+    inputs = list(inputs)
+    start = time.perf_counter()
+    written = failed = skipped = 0
+    names = set()
+
+    def report():
+        if progress:
+            progress(written + skipped, len(inputs))
+
+    def write(name, image):
+        nonlocal written
+        # ZIP inputs from different folders can share a basename; number the later ones
+        output_name = _output_name(name)
+        stem, extension = os.path.splitext(output_name)
+        count = 1
+        while output_name in names:
+            count += 1
+            output_name = f"{stem}_{count}{extension}"
+        names.add(output_name)
+        archive.writestr(output_name, _encode(image))
+        written += 1
+        report()
+
+    def tag_chunk(chunk):
+        tags = api.get_image_tags_batch([item[3] for item in chunk], [item[1] for item in chunk])
+        return list(zip(chunk, tags))
+
+    with ProcessPoolExecutor(workers) as cpu_pool, ThreadPoolExecutor(api_concurrency) as api_pool, \
+            zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as archive:
+        render_futures = [cpu_pool.submit(render_job, name, data, settings) for name, data in inputs]
+
+        tag_futures, chunk = {}, []
+        for future in as_completed(render_futures):
+            try:
+                chunk.append(future.result())
+            except Exception:
+                # Corrupt or oversized photo: the rest of the batch goes on without it
+                skipped += 1
+                report()
+                continue
+            if len(chunk) == tag_batch_size:
+                tag_futures[api_pool.submit(tag_chunk, chunk)] = chunk
+                chunk = []
+        if chunk:
+            tag_futures[api_pool.submit(tag_chunk, chunk)] = chunk
+
+        # Images with the same top tags share one prompt, so only one text call is made for them
+        text_futures, waiting = {}, {}
+        for future in as_completed(tag_futures):
+            try:
+                tagged = future.result()
+            except Exception:
+                tagged = [(item, []) for item in tag_futures[future]]
+            for item, tags in tagged:
+                if not tags:
+                    failed += 1
+                    write(item[0], item[2])
+                    continue
+                prompt = build_prompt(settings.text_option, tags)
+                if prompt not in text_futures:
+                    text_futures[prompt] = api_pool.submit(api.get_text, prompt)
+                    waiting[text_futures[prompt]] = []
+                waiting[text_futures[prompt]].append(item)
+
+        for future in as_completed(waiting):
+            try:
+                text = future.result()
+            except Exception:
+                text = ''
+            for name, _, image, _ in waiting[future]:
+                processor = ImageProcessor(image)
+                if text:
+                    processor.add_text(text, settings.text_position, settings.font_color, settings.bg_color,
+                                       settings.font_size)
+                else:
+                    failed += 1
+                write(name, processor.image)
+
+    seconds = time.perf_counter() - start
+    return {
+        'images': len(inputs),
+        'without_text': failed,
+        'skipped': skipped,
+        'seconds': seconds,
+        'images_per_second': len(inputs) / seconds if seconds else 0.0,
+    }
+
+
+def _encode(image):
+    return ImageProcessor(image).encode('JPEG', quality=90)
+
+
+def batch_page():
+    # Multi-file upload mode of the Streamlit app
+    uploaded_files = st.file_uploader("Choose images or a ZIP...", type=["jpg", "jpeg", "zip"],
+                                      accept_multiple_files=True)
+    settings = BatchSettings(
+        filter_option=st.sidebar.selectbox('Apply Filter:', FILTER_OPTIONS),
+        size=(st.sidebar.slider("Select Image Width:", 100, 800, 400),
+              st.sidebar.slider("Select Image Height:", 100, 800, 400)),
+        border_option=st.sidebar.selectbox('Do You Wanna Apply Border?', ('Original',) + tuple(BORDERS)),
+        text_option=st.sidebar.selectbox('Text Type:', TEXT_OPTIONS),
+        text_position=st.sidebar.selectbox('Text Position:', TEXT_POSITIONS),
+        font_size=st.sidebar.slider('Font Size:', 8, 40, 15),
+        font_color=st.sidebar.color_picker('Font Color:', '#ffffff'),
+    )
+
+    if uploaded_files and st.button('Process Batch'):
+        inputs = []
+        for uploaded_file in uploaded_files:
+            if uploaded_file.name.lower().endswith('.zip'):
+                inputs.extend(read_inputs(uploaded_file))
+            else:
+                inputs.append((uploaded_file.name, uploaded_file.getvalue()))
+
+        bar = st.progress(0.0)
+        output = io.BytesIO()
+        stats = run_batch(inputs, settings, output, api=ClarifaiAPI(session=session_id()),
+                          progress=lambda done, total: bar.progress(done / total))
+        st.metric('Throughput', f"{stats['images_per_second']:.1f} images/s",
+                  f"{stats['images']} images in {stats['seconds']:.1f} s")
+        if stats['skipped']:
+            st.warning(f"{stats['skipped']} images could not be read and were left out.")
+        if stats['without_text']:
+            st.warning(f"{stats['without_text']} images could not be captioned and were saved without text.")
+        st.download_button('Download ZIP', data=output.getvalue(), file_name='poeticapic_batch.zip')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a directory or ZIP of photos through PoeticaPic.")
+    parser.add_argument('source', help="directory or .zip of .jpg/.png images")
+    parser.add_argument('-o', '--output', default='poeticapic_batch.zip', help="output ZIP, '-' for stdout")
+    parser.add_argument('--filter', default='Original', choices=FILTER_OPTIONS)
+    parser.add_argument('--border', default='Original', choices=('Original',) + tuple(BORDERS))
+    parser.add_argument('--width', type=int, default=400)
+    parser.add_argument('--height', type=int, default=400)
+    parser.add_argument('--text-type', default='Life Quote', choices=TEXT_OPTIONS)
+    parser.add_argument('--text-position', default='Bottom Center', choices=TEXT_POSITIONS)
+    parser.add_argument('--font-color', default='#ffffff')
+    parser.add_argument('--bg-color')
+    parser.add_argument('--font-size', type=int, default=15)
+    parser.add_argument('--workers', type=int, help="render processes (default: CPU count)")
+    parser.add_argument('--api-concurrency', type=int, default=API_CONCURRENCY)
+    parser.add_argument('--tag-batch-size', type=int, default=TAG_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    settings = BatchSettings(args.filter, (args.width, args.height), args.border, args.text_type,
+                             args.text_position, args.font_color, args.bg_color, args.font_size)
+    output = sys.stdout.buffer if args.output == '-' else args.output
+    stats = run_batch(read_inputs(args.source), settings, output, workers=args.workers,
+                      api_concurrency=args.api_concurrency, tag_batch_size=args.tag_batch_size)
+    print(f"{stats['images']} images in {stats['seconds']:.2f} s "
+          f"({stats['images_per_second']:.1f} images/s, {stats['without_text']} without text, "
+          f"{stats['skipped']} skipped)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
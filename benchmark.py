@@ -0,0 +1,358 @@
+## python benchmark.py --sizes 1 4 --json results.json --compare baseline.json
+
+import argparse
+import inspect
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+# app.py reads these at import time; the benchmark never talks to the real API
+os.environ.setdefault("PAT", "benchmark")
+os.environ.setdefault("RESULT_CACHE_PATH", ":memory:")
+
+from PIL import Image
+
+from clarifai_grpc.grpc.api import resources_pb2, service_pb2
+
+import FakeClarifai
+from app import ClarifaiAPI, ImageProcessor, FILTER_OPTIONS, TEXT_POSITIONS, build_prompt
+from ClarifaiClient import ClarifaiClient
+from gallery import render_gallery
+from ImageBorder import BORDERS, ImageBorder
+from RenderCache import RenderCache
+from WorkflowScheduler import WorkflowScheduler
+
+SIZES_MP = (1, 4, 12)
+# A case regresses when it gets this much slower than the baseline...
+REGRESSION_THRESHOLD = 0.25
+# ...and by more than this, so timer noise on sub-millisecond cases is ignored
+NOISE_SECONDS = 0.002
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_TEXT = "Waves remember the sun, and the sand keeps every footprint we were too busy to notice"
+
+
+def make_image(megapixels):
+    # 4:3 photo-shaped gradient so the filters have real work to do
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = int(megapixels * 1_000_000 / width)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    return Image.merge("RGB", (gradient, gradient.rotate(90).resize((width, height)), gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+
+
+def make_jpeg(megapixels):
+    buffer = io.BytesIO()
+    make_image(megapixels).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def legacy_sepia(img):
+    # The original per-pixel implementation, kept only as a baseline
+    img = img.convert("RGB")
+    new_pixels = []
+    for r, g, b in img.getdata():
+        new_pixels.append((int(0.393 * r + 0.769 * g + 0.189 * b),
+                           int(0.349 * r + 0.686 * g + 0.168 * b),
+                           int(0.272 * r + 0.534 * g + 0.131 * b)))
+    img.putdata(new_pixels)
+    return img
+
+
+def timed(func, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+class RSSSampler(threading.Thread):
+    # Pillow allocates pixel buffers in C where tracemalloc can't see them, so also watch RSS
+    def __init__(self, interval=0.001):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.baseline = self.peak = _rss_bytes()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, _rss_bytes())
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.peak = max(self.peak, _rss_bytes())
+        return self.peak - self.baseline
+
+
+def measure(func, repeat=3):
+    """Best-of-``repeat`` wall time, then one instrumented run for memory and allocations."""
+    seconds = timed(func, repeat=repeat)
+
+    sampler = RSSSampler() if _rss_bytes() is not None else None
+    if sampler:
+        sampler.start()
+    images_before = Image.core.get_stats()["new_count"]
+    tracemalloc.start()
+    try:
+        func()
+        _, python_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        rss_delta = sampler.stop() if sampler else None
+    return {
+        "seconds": seconds,
+        "peak_python_bytes": python_peak,
+        "peak_rss_delta_bytes": rss_delta,
+        # Pillow image buffers created during the run
+        "image_allocations": Image.core.get_stats()["new_count"] - images_before,
+    }
+
+
+def filter_cases(img):
+    for option in FILTER_OPTIONS:
+        yield f"filter/{option}", lambda option=option: ImageProcessor(img).apply_filter(option)
+
+    def tiled(option):
+        # A budget small enough that every size runs in strips
+        processor = ImageProcessor(img)
+        processor.memory_budget = 16 * 1024 * 1024
+        processor.apply_filter(option)
+
+    for option in ("MEDIAN_FILTER", "GAUSSIAN_BLUR"):
+        yield f"tiled/{option}", lambda option=option: tiled(option)
+
+
+def border_cases(img):
+    for name, method in inspect.getmembers(ImageBorder, inspect.isfunction):
+        if not name.startswith("_"):
+            yield f"border/{name}", lambda method=method: method(img)
+
+
+def text_cases(img):
+    # Text is drawn after the resize, so its cost depends on the output size, not the upload
+    small = img.resize((800, 600))
+    for position in TEXT_POSITIONS:
+        yield f"text/{position}", lambda position=position: ImageProcessor(small.copy()).add_text(
+            SAMPLE_TEXT, position, "#ffffff", "#000000", 20)
+    yield "text/auto_fit", lambda: ImageProcessor(small.copy()).add_text(
+        SAMPLE_TEXT, "Center", "#ffffff", None, 60, auto_fit=True)
+
+
+def pipeline_cases(data):
+    image_hash = RenderCache.content_hash(data)
+
+    def render(filter_option, preview):
+        processor = ImageProcessor(ImageProcessor.open(data))
+        processor.apply_pipeline(image_hash, filter_option, (400, 400), "Polaroids", seed=1, preview=preview,
+                                 cache=RenderCache(0))
+
+    for filter_option in ("SEPIA", "MEDIAN_FILTER"):
+        yield f"pipeline/{filter_option}/full", lambda f=filter_option: render(f, False)
+        yield f"pipeline/{filter_option}/preview", lambda f=filter_option: render(f, True)
+
+    # Every gallery variant as separate previews (one selectbox change each) vs. one shared-decode gallery
+    variants = [(f, "Polaroids") for f in FILTER_OPTIONS] + [("SEPIA", b) for b in ("Original",) + tuple(BORDERS)]
+
+    def one_at_a_time():
+        for filter_option, border_option in variants:
+            processor = ImageProcessor(ImageProcessor.open(data))
+            processor.apply_pipeline(image_hash, filter_option, (400, 400), border_option, seed=1, preview=True,
+                                     cache=RenderCache(0))
+
+    yield "pipeline/gallery/one_at_a_time", one_at_a_time
+    yield "pipeline/gallery/shared_base", lambda: render_gallery(
+        image_hash, lambda: ImageProcessor.open(data), (400, 400), "SEPIA", "Polaroids", seed=1, cache=RenderCache(0))
+
+
+def end_to_end_cases(data, address):
+    # Upload -> tags -> text -> render -> caption -> encode, with FakeClarifai standing in for the API
+    api = ClarifaiAPI(ClarifaiClient(address, insecure=True), cache=None)
+    image_hash = RenderCache.content_hash(data)
+
+    def generate():
+        tags = api.get_image_tags(ImageProcessor.open(data), len(data), image_hash, in_place=True)
+        text = api.get_text(build_prompt("Life Quote", tags))
+        processor = ImageProcessor(ImageProcessor.open(data))
+        processor.apply_pipeline(image_hash, "SEPIA", (400, 400), "Wooden Frame", seed=1, cache=RenderCache(0))
+        processor.add_text(text, "Bottom Center", "#ffffff", "#000000", 15)
+        processor.encode("JPEG", 90)
+
+    yield "e2e/generate", generate
+
+
+def startup_cases(address):
+    # Cold start as a new container or worker pays it: a fresh interpreter, no PAT, FakeClarifai as the API
+    env = {key: value for key, value in os.environ.items() if key != "PAT"}
+    env.update(CLARIFAI_GRPC_BASE=address, CLARIFAI_GRPC_INSECURE="1")
+
+    def cold(statement):
+        subprocess.run([sys.executable, "-c", statement], env=env, check=True, cwd=REPO_DIR)
+
+    yield "startup/python", lambda: cold("pass")
+    yield "startup/import_app", lambda: cold("import app")
+    yield "startup/import_app+warm_up", lambda: cold("import app; app.warm_up()")
+
+
+def import_profile(module="app", top=15):
+    """The ``top`` slowest imports (cumulative ms) of a cold ``import module``, from python -X importtime."""
+    env = {key: value for key, value in os.environ.items() if key != "PAT"}
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], env=env, check=True,
+                            cwd=REPO_DIR, capture_output=True, text=True).stderr
+    rows = []
+    for line in output.splitlines():
+        if line.startswith("import time:") and "|" in line and "cumulative" not in line:
+            _, cumulative, name = line.split("|")
+            rows.append((int(cumulative) / 1000, name.rstrip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def run_suite(sizes, legacy=False, only=None):
+    results = {}
+    server, _, address = FakeClarifai.serve()
+    try:
+        for name, func in startup_cases(address):
+            if only and only not in name:
+                continue
+            results[name] = measure(func)
+            print(format_row(name, results[name]), flush=True)
+        for mp in sizes:
+            img = make_image(mp)
+            data = make_jpeg(mp)
+            cases = [*filter_cases(img), *border_cases(img), *text_cases(img), *pipeline_cases(data),
+                     *end_to_end_cases(data, address)]
+            if legacy:
+                cases.append(("legacy/sepia_loop", lambda img=img: legacy_sepia(img)))
+            for name, func in cases:
+                key = f"{name}@{mp:g}MP"
+                if only and only not in key:
+                    continue
+                # The pure-Python loop is far too slow to repeat
+                results[key] = measure(func, repeat=1 if name.startswith("legacy/") else 3)
+                print(format_row(key, results[key]), flush=True)
+    finally:
+        server.stop(None)
+    return results
+
+
+def format_row(key, result):
+    rss = result["peak_rss_delta_bytes"]
+    rss = f"{rss / 1e6:>8.1f}" if rss is not None else f"{'n/a':>8}"
+    return (f"{key:<36} {result['seconds'] * 1000:>9.2f} ms {rss} MB rss "
+            f"{result['peak_python_bytes'] / 1e6:>7.2f} MB py {result['image_allocations']:>4} images")
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """(key, old, new) for every case that got more than ``threshold`` slower than ``baseline``."""
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        old, new = baseline[key]["seconds"], result["seconds"]
+        if new - old > NOISE_SECONDS and new > old * (1 + threshold):
+            regressions.append((key, old, new))
+    return regressions
+
+
+def _tag_request(image=b"jpeg"):
+    return service_pb2.PostWorkflowResultsRequest(
+        workflow_id="bench",
+        inputs=[resources_pb2.Input(data=resources_pb2.Data(image=resources_pb2.Image(base64=image)))],
+    )
+
+
+def bench_clarifai(calls=50):
+    server, servicer, address = FakeClarifai.serve()
+    request = _tag_request()
+
+    def channel_per_call():
+        client = ClarifaiClient(address, insecure=True)
+        client.call("PostWorkflowResults", request)
+        client.close()
+
+    shared = ClarifaiClient(address, insecure=True)
+    per_call = timed(lambda: [channel_per_call() for _ in range(calls)], repeat=1) / calls
+    reused = timed(lambda: [shared.call("PostWorkflowResults", request) for _ in range(calls)], repeat=1) / calls
+    print(f"channel per call {per_call * 1000:>7.2f} ms   shared channel {reused * 1000:>7.2f} ms")
+
+    # Transient UNAVAILABLE answers are retried with backoff
+    servicer.fail_first = servicer.calls + 2
+    start = time.perf_counter()
+    shared.call("PostWorkflowResults", request)
+    print(f"2 injected UNAVAILABLE, recovered in {time.perf_counter() - start:.3f} s")
+
+    # Server restart on the same port: the shared channel reconnects by itself
+    port = int(address.rsplit(":", 1)[1])
+    server.stop(None).wait()
+    server, servicer, address = FakeClarifai.serve(port=port)
+    start = time.perf_counter()
+    shared.call("PostWorkflowResults", request)
+    print(f"server restart, reconnected in {time.perf_counter() - start:.3f} s")
+
+    # 16 sessions tagging at once, half of them the same image: sent one by one vs. through the scheduler
+    requests = [_tag_request(b"viral" if i % 2 else b"photo %d" % i) for i in range(16)]
+    servicer.latency = 0.05
+    for label, scheduler in (("direct", None), ("scheduled", WorkflowScheduler(rate=0, batched_workflows={"bench"}))):
+        servicer.calls = 0
+        send = (lambda request: scheduler.submit(shared, request)) if scheduler else \
+            (lambda request: shared.call("PostWorkflowResults", request))
+        with ThreadPoolExecutor(len(requests)) as pool:
+            start = time.perf_counter()
+            list(pool.map(send, requests))
+        print(f"16 concurrent tag calls, {label:>9}: {servicer.calls:>2} requests in {time.perf_counter() - start:.3f} s")
+
+    shared.close()
+    server.stop(None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time every filter, border and text path of PoeticaPic.")
+    parser.add_argument("--sizes", type=float, nargs="+", default=SIZES_MP, help="input sizes in megapixels")
+    parser.add_argument("--only", help="run only cases whose name contains this string")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results JSON of an earlier run to check for regressions")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="allowed slowdown against --compare (default: 0.25 = 25%%)")
+    parser.add_argument("--legacy", action="store_true", help="also time the old per-pixel SEPIA loop")
+    parser.add_argument("--clarifai", action="store_true", help="also time channel reuse, retries and reconnects")
+    parser.add_argument("--import-profile", action="store_true", help="also list the slowest imports of app.py")
+    args = parser.parse_args(argv)
+
+    results = run_suite(args.sizes, args.legacy, args.only)
+    if args.clarifai:
+        bench_clarifai()
+    if args.import_profile:
+        for ms, name in import_profile():
+            print(f"{ms:>8.1f} ms  {name}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"python": sys.version.split()[0], "results": results}, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for key, old, new in regressions:
+            print(f"REGRESSION {key}: {old * 1000:.2f} ms -> {new * 1000:.2f} ms")
+        if regressions:
+            return 1
+        print(f"No regressions over {args.threshold:.0%} against {args.compare}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
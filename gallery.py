@@ -0,0 +1,105 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+from app import ImageProcessor, FILTER_OPTIONS, render_cache
+from ImageBorder import BORDERS
+from Tracer import tracer
+
+GALLERY_THUMBNAIL_SIDE = 200
+GALLERY_COLUMNS = 4
+# Pillow releases the GIL while filtering and resizing, so threads run the variants in parallel
+# and can all read the shared stages; processes would have to pickle them for every task
+GALLERY_WORKERS = os.cpu_count() or 1
+_pool = ThreadPoolExecutor(max_workers=GALLERY_WORKERS, thread_name_prefix="gallery")
+
+
+def render_gallery(image_hash, open_image, size, filter_option, border_option, seed=None, border_text=None,
+                   cache=render_cache, thumbnail_side=GALLERY_THUMBNAIL_SIDE):
+    """Thumbnails of every filter (with the chosen border) and every border (with the chosen filter).
+
+    ``open_image`` returns a fresh, lazily opened copy of the upload. Every tile
+    is rendered by ``apply_pipeline`` with the same preview plan as the main
+    preview and then shrunk to ``thumbnail_side``, so it shows exactly what
+    picking it would show. The stages the tiles have in common (the decode and
+    resize, the chosen filter) are rendered once per call, even when ``cache``
+    is too small to keep them. Returns two dicts, option -> image.
+    """
+    stages = _SharedStages(cache)
+    with tracer.span('gallery', width=size[0], height=size[1]) as span:
+        variants = [(filter_name, border_option) for filter_name in FILTER_OPTIONS]
+        variants += [(filter_option, border_name) for border_name in ('Original',) + tuple(BORDERS)]
+
+        def render(variant):
+            return _thumbnail(image_hash, open_image, size, *variant, seed, border_text, stages, thumbnail_side)
+        # The current choice first, on this thread: it renders the stages the other variants start from
+        render((filter_option, border_option))
+        thumbnails = list(_pool.map(render, variants))
+        span.set(variants=len(variants))
+
+    filters = dict(zip(FILTER_OPTIONS, thumbnails[:len(FILTER_OPTIONS)]))
+    borders = dict(zip(('Original',) + tuple(BORDERS), thumbnails[len(FILTER_OPTIONS):]))
+    return filters, borders
+
+
+class _SharedStages:
+    # The render cache as seen by one gallery: every stage rendered during the call is also kept here
+    def __init__(self, cache):
+        self.cache = cache
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def stage(self, key, factory, cacheable=True):
+        if not cacheable:
+            return self.cache.stage(key, factory, cacheable=False)
+        with self._lock:
+            value = self._stages.get(key)
+        if value is None:
+            value = self.cache.stage(key, factory)
+            with self._lock:
+                value = self._stages.setdefault(key, value)
+        return value
+
+
+def _thumbnail(image_hash, open_image, size, filter_option, border_option, seed, border_text, stages, side):
+    # Keyed like the preview's stages, plus the thumbnail size, so a rerun renders nothing
+    plan = ImageProcessor(open_image()).plan(filter_option, size, border_option, seed, True, border_text)
+    key = (image_hash,) + plan.steps + (('thumbnail', side),)
+
+    def render():
+        processor = ImageProcessor(open_image())
+        processor.apply_pipeline(image_hash, filter_option, size, border_option, seed=seed, preview=True,
+                                 cache=stages, border_text=border_text)
+        # apply_pipeline hands back an image of its own, so it can be shrunk in place
+        processor.image.thumbnail((side, side))
+        return processor.image
+    # A random border without a seed looks different every time, so its tile must not be kept
+    spec = BORDERS.get(border_option)
+    return stages.stage(key, render, cacheable=spec is None or spec.is_deterministic(seed))
+
+
+def _choose(widget_key, value):
+    # Runs before the rerun, while the sidebar widget's value may still be changed
+    st.session_state[widget_key] = value
+
+
+def _grid(thumbnails, widget_key, current):
+    columns = st.columns(GALLERY_COLUMNS)
+    for i, (name, thumbnail) in enumerate(thumbnails.items()):
+        with columns[i % GALLERY_COLUMNS]:
+            st.image(thumbnail, caption=name)
+            st.button('Selected' if name == current else 'Use', key=f'gallery_{widget_key}_{name}',
+                      disabled=name == current, on_click=_choose, args=(widget_key, name))
+
+
+def gallery(image_hash, open_image, size, filter_option, border_option, seed=None, border_text=None):
+    # Gallery section of the single-image page; picking a thumbnail sets the matching sidebar selectbox
+    filters, borders = render_gallery(image_hash, open_image, size, filter_option, border_option, seed, border_text)
+    st.subheader('Gallery')
+    filter_tab, border_tab = st.tabs(['Filters', 'Borders'])
+    with filter_tab:
+        _grid(filters, 'filter_option', filter_option)
+    with border_tab:
+        _grid(borders, 'border_option', border_option)
@@ -0,0 +1,149 @@
+## python loadtest.py --requests 200 --concurrency 16 --workers 4
+
+import argparse
+import io
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import ImageDraw
+
+import FakeClarifai
+from benchmark import make_image
+
+# Mix of cheap and expensive renders, half of them asking Clarifai for text
+SCENARIOS = (
+    {'filter': 'SEPIA', 'border': 'Polaroids'},
+    {'filter': 'MEDIAN_FILTER', 'border': 'Wooden Frame', 'text_type': 'Love Quote'},
+    {'filter': 'BLUR', 'border': 'Pixel Frame', 'text': 'Hello from the load test', 'format': 'WebP'},
+    {'filter': 'VINTAGE', 'border': 'Filmstrip Border', 'text_type': 'Life Quote', 'auto_fit': '1'},
+)
+
+
+def make_photos(count, megapixels):
+    # Distinct content per photo, so the tag cache (including near-duplicate lookups) can't answer for the others
+    rng = random.Random(0)
+    photos = []
+    for _ in range(count):
+        img = make_image(megapixels)
+        draw = ImageDraw.Draw(img)
+        for _ in range(12):
+            x, y = rng.randrange(img.width), rng.randrange(img.height)
+            draw.rectangle([x, y, x + img.width // 4, y + img.height // 4],
+                           fill=tuple(rng.randrange(256) for _ in range(3)))
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=90)
+        photos.append(buffer.getvalue())
+    return photos
+
+
+def start_server(port, workers, max_pending, clarifai_address):
+    env = dict(os.environ, CLARIFAI_GRPC_BASE=clarifai_address, CLARIFAI_GRPC_INSECURE='1',
+               RESULT_CACHE_PATH=':memory:')
+    env.setdefault('PAT', 'loadtest')
+    command = [sys.executable, 'server.py', '--port', str(port), '--workers', str(workers)]
+    if max_pending:
+        command += ['--max-pending', str(max_pending)]
+    process = subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/healthz', timeout=1).read()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError("server.py exited during startup")
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("server.py did not start within 60 s")
+
+
+def post(port, photo, params, retry_busy=False):
+    # With retry_busy, a 503 is retried after its Retry-After like a well-behaved client would
+    request = urllib.request.Request(f'http://127.0.0.1:{port}/render?{urllib.parse.urlencode(params)}',
+                                     data=photo, headers={'Content-Type': 'image/jpeg'})
+    start = time.perf_counter()
+    retries = 0
+    while True:
+        try:
+            with urllib.request.urlopen(request, timeout=120) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as error:
+            status = error.code
+            if status == 503 and retry_busy:
+                retries += 1
+                time.sleep(float(error.headers.get('Retry-After', 1)) * random.uniform(0.5, 1.5))
+                continue
+        except OSError:
+            status = 'error'
+        return status, time.perf_counter() - start, retries
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+def run_load(port, photos, requests, concurrency, retry_busy=False):
+    jobs = [(photos[i % len(photos)], SCENARIOS[i % len(SCENARIOS)]) for i in range(requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(lambda job: post(port, *job, retry_busy), jobs))
+    seconds = time.perf_counter() - start
+
+    ok = [latency for status, latency, _ in results if status == 200]
+    statuses = {}
+    for status, _, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    return {
+        'requests': requests,
+        'statuses': statuses,
+        'busy_retries': sum(retries for _, _, retries in results),
+        'seconds': seconds,
+        'renders_per_second': len(ok) / seconds,
+        'p50': percentile(ok, 0.5),
+        'p95': percentile(ok, 0.95),
+        'p99': percentile(ok, 0.99),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test server.py against a fake Clarifai backend.")
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16, help="clients sending requests at once")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="server render processes")
+    parser.add_argument('--max-pending', type=int, help="server admission limit (default: 4 per worker)")
+    parser.add_argument('--photos', type=int, default=8, help="distinct photos to cycle through")
+    parser.add_argument('--megapixels', type=float, default=4)
+    parser.add_argument('--clarifai-latency', type=float, default=0.3, help="seconds per fake Clarifai call")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--retry-busy', action='store_true', help="retry 503 answers after their Retry-After")
+    args = parser.parse_args(argv)
+
+    server, _, address = FakeClarifai.serve(FakeClarifai.FakeV2Servicer(latency=args.clarifai_latency))
+    process = start_server(args.port, args.workers, args.max_pending, address)
+    try:
+        stats = run_load(args.port, make_photos(args.photos, args.megapixels), args.requests, args.concurrency,
+                         args.retry_busy)
+    finally:
+        process.terminate()
+        process.wait()
+        server.stop(None)
+
+    print(f"{stats['requests']} requests, {args.concurrency} clients, {args.workers} workers: "
+          f"{stats['renders_per_second']:.1f} renders/s over {stats['seconds']:.1f} s")
+    print(f"latency p50 {stats['p50']:.3f} s  p95 {stats['p95']:.3f} s  p99 {stats['p99']:.3f} s")
+    print("responses: " + ", ".join(f"{status}: {count}" for status, count in sorted(stats['statuses'].items(),
+                                                                                      key=str))
+          + f" ({stats['busy_retries']} retries after 503)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+## python server.py --port 8000 --workers 4
+## curl --data-binary @photo.jpg "localhost:8000/render?filter=SEPIA&border=Polaroids&text_type=Love%20Quote" -o out.jpg
+
+import argparse
+import asyncio
+import contextlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import uvicorn
+from PIL import Image, ImageColor, UnidentifiedImageError
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+from app import ClarifaiAPI, ImageProcessor, build_prompt, start_warm_up, FILTER_OPTIONS, TEXT_OPTIONS, TEXT_POSITIONS, \
+    OUTPUT_FORMATS
+from batch import BatchSettings, render_job
+from ImageBorder import BORDERS
+from RenderCache import RenderCache
+from Tracer import tracer
+
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", os.cpu_count() or 1))
+# Requests admitted at once (rendering, queued for a worker or waiting on Clarifai); the rest get a 503
+MAX_PENDING_RENDERS = int(os.getenv("MAX_PENDING_RENDERS", 4 * RENDER_WORKERS))
+# Clarifai calls are I/O, so many more of them than render workers can be in flight
+API_CONCURRENCY = int(os.getenv("API_CONCURRENCY", 16))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 20 * 1024 * 1024))
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", 60))
+MAX_OUTPUT_SIDE = 4096
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_options(params):
+    """Render options from query/form fields; raises RequestError(400) on bad values."""
+    def choice(name, options, default):
+        value = params.get(name, default)
+        if value not in options:
+            raise RequestError(400, f"{name} must be one of: {', '.join(options)}")
+        return value
+
+    def number(name, default, low, high, kind=int):
+        try:
+            value = kind(params.get(name, default))
+        except ValueError:
+            raise RequestError(400, f"{name} must be a number")
+        if not low <= value <= high:
+            raise RequestError(400, f"{name} must be between {low} and {high}")
+        return value
+
+    def color(name, default):
+        value = params.get(name) or default
+        if value is not None:
+            try:
+                ImageColor.getrgb(value)
+            except ValueError:
+                raise RequestError(400, f"{name} must be a colour name or #rrggbb")
+        return value
+
+    settings = BatchSettings(
+        filter_option=choice('filter', FILTER_OPTIONS, 'Original'),
+        size=(number('width', 400, 16, MAX_OUTPUT_SIDE), number('height', 400, 16, MAX_OUTPUT_SIDE)),
+        border_option=choice('border', ('Original',) + tuple(BORDERS), 'Original'),
+        text_option=choice('text_type', TEXT_OPTIONS, 'Life Quote'),
+        text_position=choice('text_position', TEXT_POSITIONS, 'Bottom Center'),
+        font_color=color('font_color', '#ffffff'),
+        bg_color=color('bg_color', None),
+        font_size=number('font_size', 15, 8, 200),
+    )
+    # Explicit text is drawn as is; otherwise text_type asks Clarifai to write some
+    text = params.get('text')
+    generate = text is None and 'text_type' in params
+    options = {
+        'auto_fit': params.get('auto_fit', '').lower() in ('1', 'true', 'yes'),
+        'output': OUTPUT_FORMATS[choice('format', tuple(OUTPUT_FORMATS), 'JPEG')],
+        'quality': number('quality', 90, 1, 100),
+    }
+    return settings, text, generate, options
+
+
+async def read_request(request):
+    """(image bytes, params) from a multipart form with an ``image`` field or a raw image body."""
+    params = dict(request.query_params)
+    if request.headers.get('content-type', '').startswith('multipart/form-data'):
+        async with request.form(max_part_size=MAX_UPLOAD_BYTES) as form:
+            upload = form.get('image')
+            if upload is None or isinstance(upload, str):
+                raise RequestError(400, "multipart requests need an 'image' file field")
+            params.update((key, value) for key, value in form.items() if isinstance(value, str))
+            data = await upload.read()
+    else:
+        if int(request.headers.get('content-length') or 0) > MAX_UPLOAD_BYTES:
+            raise RequestError(413, f"images are limited to {MAX_UPLOAD_BYTES} bytes")
+        data = bytearray()
+        async for chunk in request.stream():
+            data += chunk
+            if len(data) > MAX_UPLOAD_BYTES:
+                raise RequestError(413, f"images are limited to {MAX_UPLOAD_BYTES} bytes")
+        data = bytes(data)
+
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise RequestError(413, f"images are limited to {MAX_UPLOAD_BYTES} bytes")
+    if not data:
+        raise RequestError(400, "no image in the request")
+    return data, params
+
+
+def upload_job(data):
+    # Worker process: the small JPEG Clarifai tags, prepared while the render runs on another worker
+    return RenderCache.content_hash(data), ClarifaiAPI.prepare_upload(ImageProcessor.open(data), in_place=True)
+
+
+def finish_job(image, text, settings, auto_fit, output_format, quality):
+    # Worker process: caption and encode
+    processor = ImageProcessor(image)
+    if text:
+        processor.add_text(text, settings.text_position, settings.font_color, settings.bg_color,
+                           settings.font_size, auto_fit)
+    return processor.encode(output_format, quality)
+
+
+def generate_text(upload, image_hash, text_option, session=None):
+    # API thread: tags, then text, through the same cached ClarifaiAPI the UI uses; session is the client address.
+    # Returns (text, error); text is '' when either call failed
+    api = ClarifaiAPI(session=session)
+    tags = api.get_image_tags_batch([upload], [image_hash])[0]
+    text = api.get_text(build_prompt(text_option, tags)) if tags else ''
+    return text, None if text else api.last_error or 'text generation failed'
+
+
+async def run_render(state, jobs, data, settings, text, generate, options, session=None):
+    def submit(pool, *args):
+        # Every job handed to a pool is recorded, so render() can hold the admission slot until it has finished
+        job = pool.submit(*args)
+        jobs.append(job)
+        return asyncio.wrap_future(job)
+
+    rendering = submit(state.cpu_pool, render_job, '', data, settings, False)
+    headers = {}
+    try:
+        if generate:
+            image_hash, upload = await submit(state.cpu_pool, upload_job, data)
+            text, error = await submit(state.api_pool, generate_text, upload, image_hash, settings.text_option,
+                                       session)
+            if error:
+                # Like batch mode: the picture is still worth returning without its caption
+                headers['X-PoeticaPic-Warning'] = error
+        _, _, image, _ = await rendering
+    except BaseException:
+        # Failed or timed out before the render was collected: drop it if it is still queued
+        rendering.cancel()
+        raise
+
+    output_format, _, mime = options['output']
+    body = await submit(state.cpu_pool, finish_job, image, text, settings, options['auto_fit'], output_format,
+                        options['quality'])
+    return Response(body, media_type=mime, headers=headers)
+
+
+def release(state, jobs):
+    """Give back a request's admission slot once none of its ``jobs`` is still running.
+
+    A request that failed or timed out cancels its queued jobs; the slot stays taken
+    until the running ones finish, so admissions follow the work the pools really have.
+    """
+    for job in jobs:
+        job.cancel()
+    running = [asyncio.wrap_future(job) for job in jobs if not job.done()]
+    if not running:
+        _free_slot(state)
+        return
+
+    async def wait():
+        await asyncio.wait(running)
+        for future in running:
+            if not future.cancelled():
+                future.exception()  # retrieved, so an abandoned job's error isn't logged as unhandled
+        _free_slot(state)
+    task = asyncio.ensure_future(wait())
+    state.releasing.add(task)
+    task.add_done_callback(state.releasing.discard)
+
+
+def _free_slot(state):
+    state.pending -= 1
+    tracer.metrics.set('poeticapic_http_pending_renders', state.pending)
+
+
+async def render(request):
+    state = request.app.state
+    if state.pending >= state.max_pending:
+        # Shed load instead of queueing without bound; clients should back off and retry
+        tracer.metrics.inc('poeticapic_http_requests_total', status='503')
+        return JSONResponse({'error': "too many renders in progress, retry shortly"}, 503,
+                            headers={'Retry-After': '1'})
+
+    start = time.perf_counter()
+    state.pending += 1
+    tracer.metrics.set('poeticapic_http_pending_renders', state.pending)
+    jobs = []
+    try:
+        data, params = await read_request(request)
+        settings, text, generate, options = parse_options(params)
+        session = request.client.host if request.client else None
+        response = await asyncio.wait_for(run_render(state, jobs, data, settings, text, generate, options, session),
+                                          RENDER_TIMEOUT)
+    except RequestError as error:
+        response = JSONResponse({'error': str(error)}, error.status)
+    except UnidentifiedImageError:
+        response = JSONResponse({'error': "not a readable JPEG, PNG or WebP image"}, 400)
+    except Image.DecompressionBombError as error:
+        response = JSONResponse({'error': str(error)}, 413)
+    except asyncio.TimeoutError:
+        response = JSONResponse({'error': f"render took longer than {RENDER_TIMEOUT:g} s"}, 504)
+    except Exception as error:
+        response = JSONResponse({'error': f"render failed: {error}"}, 500)
+    finally:
+        release(state, jobs)
+
+    seconds = time.perf_counter() - start
+    tracer.metrics.observe('poeticapic_http_request_seconds', seconds, status=str(response.status_code))
+    tracer.metrics.inc('poeticapic_http_requests_total', status=str(response.status_code))
+    response.headers['X-Render-Seconds'] = f"{seconds:.3f}"
+    return response
+
+
+async def options(request):
+    return JSONResponse({
+        'filter': FILTER_OPTIONS,
+        'border': ('Original',) + tuple(BORDERS),
+        'text_type': TEXT_OPTIONS,
+        'text_position': TEXT_POSITIONS,
+        'format': tuple(OUTPUT_FORMATS),
+    })
+
+
+async def healthz(request):
+    state = request.app.state
+    return JSONResponse({'pending': state.pending, 'max_pending': state.max_pending, 'workers': state.workers})
+
+
+async def metrics(request):
+    return PlainTextResponse(tracer.metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+def create_app(workers=RENDER_WORKERS, max_pending=MAX_PENDING_RENDERS, api_concurrency=API_CONCURRENCY):
+    """ASGI app rendering with ``workers`` processes and admitting ``max_pending`` requests at once."""
+
+    @contextlib.asynccontextmanager
+    async def lifespan(application):
+        state = application.state
+        state.workers, state.max_pending, state.pending = workers, max_pending, 0
+        # Tasks holding the slots of finished requests whose jobs are still running
+        state.releasing = set()
+        state.cpu_pool = ProcessPoolExecutor(workers)
+        # Fork every worker now, before this process opens gRPC channels or starts API threads
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(state.cpu_pool, os.getpid) for _ in range(workers)))
+        state.api_pool = ThreadPoolExecutor(api_concurrency, thread_name_prefix='clarifai')
+        # Workers are forked already, so this connects the Clarifai channel in this process only
+        start_warm_up()
+        try:
+            yield
+        finally:
+            state.api_pool.shutdown(wait=False, cancel_futures=True)
+            state.cpu_pool.shutdown(cancel_futures=True)
+
+    return Starlette(routes=[
+        Route('/render', render, methods=['POST']),
+        Route('/options', options),
+        Route('/healthz', healthz),
+        Route('/metrics', metrics),
+    ], lifespan=lifespan)
+
+
+# For `uvicorn server:application`; configured through the environment variables above
+application = create_app()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the PoeticaPic render pipeline over HTTP.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=RENDER_WORKERS, help="render processes")
+    parser.add_argument('--max-pending', type=int, help="admitted requests before answering 503 "
+                                                        "(default: 4 per worker)")
+    parser.add_argument('--api-concurrency', type=int, default=API_CONCURRENCY)
+    args = parser.parse_args(argv)
+    uvicorn.run(create_app(args.workers, args.max_pending or 4 * args.workers, args.api_concurrency),
+                host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == "__main__":
+    main()
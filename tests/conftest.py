@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+# Tests import the top-level modules directly, like the scripts do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# app.py reads these at import time; tests never talk to the real API
+os.environ.setdefault("PAT", "test")
+os.environ.setdefault("RESULT_CACHE_PATH", ":memory:")
+
+
+@pytest.fixture
+def fake_clarifai():
+    """(servicer, ClarifaiClient) for a FakeClarifai server on a free localhost port."""
+    import FakeClarifai
+    from ClarifaiClient import ClarifaiClient
+
+    server, servicer, address = FakeClarifai.serve()
+    client = ClarifaiClient(address, insecure=True, initial_backoff=0.01)
+    yield servicer, client
+    client.close()
+    server.stop(None)
@@ -0,0 +1,26 @@
+import os
+import runpy
+import subprocess
+import sys
+
+import app
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+
+def test_import_leaves_grpc_for_the_first_api_call():
+    # A fresh interpreter, since other tests have long imported grpc into this one
+    code = "import sys, app; print(sorted(m for m in ('grpc', 'clarifai_grpc') if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(APP_PATH), env=dict(os.environ),
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.strip().splitlines()[-1] == "[]"
+
+
+def test_reruns_share_the_imported_module_state(monkeypatch):
+    monkeypatch.setattr(app, "main", lambda: None)
+    monkeypatch.setattr(app, "start_warm_up", lambda: None)
+    # What `streamlit run app.py` does on every rerun
+    reruns = [runpy.run_path(APP_PATH, run_name="__main__") for _ in range(2)]
+    for names in reruns:
+        for name in ("render_cache", "result_cache", "image_store", "workflow_scheduler"):
+            assert names[name] is getattr(app, name)
@@ -0,0 +1,67 @@
+import io
+import zipfile
+
+import grpc
+import pytest
+from PIL import Image
+
+import app
+from app import ClarifaiAPI, ImageProcessor
+from batch import BatchSettings, run_batch
+from WorkflowScheduler import WorkflowScheduler
+
+
+def jpeg(color):
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), color).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def run(client, inputs, scheduler=None):
+    output = io.BytesIO()
+    api = ClarifaiAPI(client, cache=None, scheduler=scheduler)
+    stats = run_batch(inputs, BatchSettings(size=(32, 32)), output, api=api, workers=1)
+    with zipfile.ZipFile(output) as archive:
+        return stats, sorted(archive.namelist())
+
+
+def test_unreadable_photo_is_skipped_and_same_names_are_numbered(fake_clarifai):
+    _, client = fake_clarifai
+    stats, names = run(client, [("x.jpg", jpeg("red")), ("x.jpg", jpeg("blue")), ("broken.jpg", b"not a photo")])
+
+    assert names == ["x_poetica.jpg", "x_poetica_2.jpg"]
+    assert stats["skipped"] == 1
+    assert stats["without_text"] == 0
+
+
+@pytest.mark.parametrize("scheduled", [False, True])
+def test_one_rejected_photo_keeps_the_rest_of_its_request_captioned(fake_clarifai, scheduled):
+    servicer, client = fake_clarifai
+    bad = jpeg("green")
+    servicer.bad_images = {ClarifaiAPI.prepare_upload(ImageProcessor.open(bad), in_place=True)}
+    scheduler = WorkflowScheduler(rate=0, batched_workflows={app.WORKFLOW_ID_IMAGE}) if scheduled else None
+    stats, names = run(client, [("a.jpg", jpeg("red")), ("b.jpg", bad), ("c.jpg", jpeg("blue"))], scheduler)
+
+    assert len(names) == 3
+    assert stats["without_text"] == 1
+
+
+def test_failed_api_calls_still_write_every_photo(fake_clarifai):
+    servicer, client = fake_clarifai
+    servicer.fail_first, servicer.fail_code = 100, grpc.StatusCode.PERMISSION_DENIED
+    stats, names = run(client, [("a.jpg", jpeg("red")), ("b.jpg", jpeg("blue"))])
+
+    assert names == ["a_poetica.jpg", "b_poetica.jpg"]
+    assert stats["without_text"] == 2
+
+
+def test_exception_in_tagging_does_not_abort_the_batch(fake_clarifai, monkeypatch):
+    _, client = fake_clarifai
+
+    def broken(self, uploads, image_hashes=None):
+        raise RuntimeError("tagging crashed")
+    monkeypatch.setattr(ClarifaiAPI, "get_image_tags_batch", broken)
+    stats, names = run(client, [("a.jpg", jpeg("red"))])
+
+    assert names == ["a_poetica.jpg"]
+    assert stats["without_text"] == 1
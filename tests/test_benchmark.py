@@ -0,0 +1,24 @@
+import pytest
+
+import benchmark
+import FakeClarifai
+
+
+@pytest.fixture(scope="module")
+def cases():
+    server, _, address = FakeClarifai.serve()
+    img = benchmark.make_image(0.02)
+    data = benchmark.make_jpeg(0.02)
+    yield [*benchmark.filter_cases(img), *benchmark.border_cases(img), *benchmark.text_cases(img),
+           *benchmark.pipeline_cases(data), *benchmark.end_to_end_cases(data, address),
+           ("legacy/sepia_loop", lambda: benchmark.legacy_sepia(img))]
+    server.stop(None)
+
+
+def test_every_case_runs_once(cases):
+    # Smoke test on a tiny image, so a broken case shows up here instead of halfway through a real run
+    names = [name for name, _ in cases]
+    assert len(names) == len(set(names))
+    assert any(name.startswith("border/") for name in names)
+    for name, func in cases:
+        func()
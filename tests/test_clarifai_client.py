@@ -0,0 +1,67 @@
+import grpc
+import pytest
+from clarifai_grpc.grpc.api import resources_pb2, service_pb2
+
+
+def text_request():
+    return service_pb2.PostWorkflowResultsRequest(
+        workflow_id="text", inputs=[resources_pb2.Input(data=resources_pb2.Data(text=resources_pb2.Text(raw="hi")))])
+
+
+def fail_first(servicer, code):
+    servicer.fail_first, servicer.fail_code = 1, code
+
+
+@pytest.mark.parametrize("code", [grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.RESOURCE_EXHAUSTED])
+def test_transient_errors_are_retried(fake_clarifai, code):
+    servicer, client = fake_clarifai
+    fail_first(servicer, code)
+
+    response = client.call("PostWorkflowResults", text_request())
+    assert response.results[0].outputs[0].data.text.raw
+    assert servicer.calls == 2
+
+
+def test_timeouts_are_retried_only_for_idempotent_calls(fake_clarifai):
+    servicer, client = fake_clarifai
+    fail_first(servicer, grpc.StatusCode.DEADLINE_EXCEEDED)
+    with pytest.raises(grpc.RpcError) as error:
+        client.call("PostWorkflowResults", text_request())
+    assert error.value.code() == grpc.StatusCode.DEADLINE_EXCEEDED
+    assert servicer.calls == 1
+
+    servicer.calls = 0
+    client.call("PostWorkflowResults", text_request(), idempotent=True)
+    assert servicer.calls == 2
+
+
+def test_permanent_errors_are_not_retried(fake_clarifai):
+    servicer, client = fake_clarifai
+    fail_first(servicer, grpc.StatusCode.PERMISSION_DENIED)
+    with pytest.raises(grpc.RpcError):
+        client.call("PostWorkflowResults", text_request(), idempotent=True)
+    assert servicer.calls == 1
+
+
+def test_unknown_methods_are_attribute_errors(fake_clarifai):
+    _, client = fake_clarifai
+    with pytest.raises(AttributeError):
+        client.stub.NoSuchMethod
+
+
+def test_api_errors_are_returned_for_the_script_thread(fake_clarifai, monkeypatch):
+    import streamlit as st
+    from concurrent.futures import ThreadPoolExecutor
+    from app import ClarifaiAPI
+
+    def draw(*args, **kwargs):
+        raise AssertionError("Streamlit called from a worker thread")
+    monkeypatch.setattr(st, "write", draw)
+    monkeypatch.setattr(st, "error", draw)
+    servicer, client = fake_clarifai
+    fail_first(servicer, grpc.StatusCode.PERMISSION_DENIED)
+    api = ClarifaiAPI(client, cache=None, scheduler=None)
+
+    with ThreadPoolExecutor(1) as pool:
+        assert pool.submit(api.post_workflow_results, text_request()).result() is None
+    assert api.last_error == "Post workflow results failed, status: PERMISSION_DENIED"
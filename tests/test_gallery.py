@@ -0,0 +1,49 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app import ImageProcessor
+from gallery import render_gallery
+from RenderCache import RenderCache
+
+
+def upload(size):
+    rng = np.random.default_rng(1)
+    buffer = io.BytesIO()
+    Image.fromarray(rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def preview(data, filter_option, size, border_option):
+    processor = ImageProcessor(ImageProcessor.open(data))
+    processor.apply_pipeline("h", filter_option, size, border_option, seed=7, preview=True, cache=RenderCache(0))
+    processor.image.thumbnail((200, 200))
+    return np.asarray(processor.image)
+
+
+# Larger than the preview size, and smaller, where the preview filters before it resizes
+@pytest.mark.parametrize("source_size", [(640, 480), (160, 120)])
+def test_tiles_match_the_preview(source_size):
+    data = upload(source_size)
+    filters, borders = render_gallery("h", lambda: ImageProcessor.open(data), (400, 300), "POP ART", "Pixel Frame",
+                                      seed=7, cache=RenderCache(0))
+
+    assert np.array_equal(np.asarray(filters["BLUR"]), preview(data, "BLUR", (400, 300), "Pixel Frame"))
+    assert np.array_equal(np.asarray(borders["Polaroids"]), preview(data, "POP ART", (400, 300), "Polaroids"))
+    assert np.array_equal(np.asarray(borders["Original"]), preview(data, "POP ART", (400, 300), "Original"))
+
+
+def test_unseeded_random_borders_are_not_cached():
+    from ImageBorder import BORDERS
+
+    data = upload((320, 240))
+    cache = RenderCache(64 * 1024 * 1024)
+    for _ in range(2):
+        filters, borders = render_gallery("h", lambda: ImageProcessor.open(data), (200, 150), "SEPIA",
+                                          "Glitch Frame", cache=cache)
+    # Second run: only tiles that look the same every time came from the cache
+    random_borders = sum(not spec.is_deterministic() for spec in BORDERS.values())
+    thumbnails = cache.stats()["stages"]["thumbnail"]
+    assert thumbnails["hits"] == len(borders) - random_borders
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from ImageBorder import BORDERS
+
+SEEDED = [name for name, spec in BORDERS.items() if 'seed' in spec.params]
+
+
+def photo():
+    rng = np.random.default_rng(5)
+    return Image.fromarray(rng.integers(0, 256, (120, 160, 3), dtype=np.uint8))
+
+
+def render(name, seed):
+    return np.asarray(BORDERS[name].apply(photo(), seed=seed))
+
+
+@pytest.mark.parametrize("name", SEEDED)
+def test_same_seed_same_frame(name):
+    assert np.array_equal(render(name, 42), render(name, 42))
+
+
+@pytest.mark.parametrize("name", SEEDED)
+def test_different_seeds_differ(name):
+    assert not np.array_equal(render(name, 1), render(name, 2))
+
+
+@pytest.mark.parametrize("name", sorted(BORDERS))
+def test_determinism_flag_matches_the_output(name):
+    spec = BORDERS[name]
+    assert spec.is_deterministic(seed=7)
+    if spec.deterministic:
+        assert np.array_equal(render(name, None), render(name, None))
+    else:
+        assert not spec.is_deterministic()
+
+
+@pytest.mark.parametrize("name", sorted(BORDERS))
+def test_output_size_is_known_before_rendering(name):
+    spec = BORDERS[name]
+    assert spec.apply(photo(), seed=3).size == spec.size((160, 120))
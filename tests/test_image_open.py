@@ -0,0 +1,53 @@
+import io
+
+import pytest
+from PIL import Image
+
+from app import ImageProcessor
+
+
+def encode(fmt, size=(400, 300)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, 'teal').save(buffer, fmt)
+    return buffer.getvalue()
+
+
+def test_pillow_limit_is_left_alone():
+    # Pillow's default, not something importing app raised for every other image in the process
+    assert Image.MAX_IMAGE_PIXELS == int(1024 * 1024 * 1024 // 4 // 3)
+
+
+def test_large_jpeg_is_drafted_before_decoding():
+    image = ImageProcessor.open(encode('JPEG'), max_pixels=400 * 300 // 4)
+    assert image.size == (200, 150)
+
+
+def test_large_png_is_rejected_before_decoding():
+    with pytest.raises(Image.DecompressionBombError):
+        ImageProcessor.open(encode('PNG'), max_pixels=400 * 300 // 4)
+
+
+def test_shrinking_for_upload_leaves_the_callers_image_alone():
+    from app import ClarifaiAPI
+
+    image = ImageProcessor.open(encode('JPEG', (1600, 1200)))
+    image.load()
+    small = ClarifaiAPI.shrink_for_upload(image, max_side=400)
+    assert (image.size, small.size) == ((1600, 1200), (400, 300))
+
+    owned = ImageProcessor.open(encode('JPEG', (1600, 1200)))
+    assert ClarifaiAPI.shrink_for_upload(owned, max_side=400, in_place=True).size == (400, 300)
+
+
+def test_tagging_shrinks_only_images_handed_over(fake_clarifai):
+    from app import ClarifaiAPI
+
+    servicer, client = fake_clarifai
+    api = ClarifaiAPI(client, cache=None, scheduler=None)
+    kept = ImageProcessor.open(encode('JPEG', (1600, 1200)))
+    assert api.get_image_tags(kept)
+    assert kept.size == (1600, 1200)
+
+    owned = ImageProcessor.open(encode('JPEG', (1600, 1200)))
+    assert api.get_image_tags(owned, in_place=True)
+    assert max(owned.size) < 1600
@@ -0,0 +1,21 @@
+import os
+
+from ImageStore import ImageStore
+
+
+def test_gc_scans_are_rate_limited(tmp_path, monkeypatch):
+    store = ImageStore(str(tmp_path), max_bytes=1000, gc_interval=3600)
+    scans = []
+    scan = os.scandir
+    monkeypatch.setattr(os, "scandir", lambda path: scans.append(path) or scan(path))
+
+    for i in range(5):
+        store.put(b"%d" % i * 10, "jpg")
+    assert len(scans) == 1
+
+
+def test_writing_past_max_bytes_collects_straight_away(tmp_path):
+    store = ImageStore(str(tmp_path), max_bytes=250, gc_interval=3600)
+    for i in range(5):
+        store.put(bytes([i]) * 100, "jpg")
+    assert sum(entry.stat().st_size for entry in os.scandir(tmp_path)) <= 250
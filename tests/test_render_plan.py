@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from app import ImageProcessor
+from RenderCache import RenderCache
+
+
+def photo():
+    rng = np.random.default_rng(0)
+    return Image.fromarray(rng.integers(0, 256, (300, 400, 3), dtype=np.uint8))
+
+
+@pytest.mark.parametrize("filter_option", ["POP ART", "HIGH CONTRAST", "VINTAGE", "SEPIA", "BLUR"])
+def test_full_quality_filters_before_the_resize(filter_option):
+    steps = ImageProcessor(photo()).plan(filter_option, (100, 75), "Original").steps
+    assert [step[0] for step in steps] == ["filter", "resize"]
+
+    processor = ImageProcessor(photo())
+    processor.apply_pipeline("h", filter_option, (100, 75), "Original", cache=RenderCache(0))
+    expected = ImageProcessor(photo())
+    expected.apply_filter(filter_option)
+    assert np.array_equal(np.asarray(processor.image), np.asarray(expected.image.resize((100, 75))))
+
+
+def test_preview_filters_the_downscaled_image():
+    steps = ImageProcessor(photo()).plan("POP ART", (100, 75), "Original", preview=True).steps
+    assert [step[0] for step in steps] == ["resize", "filter"]
+
+
+@pytest.mark.parametrize("border", ["Framed Border", "Grunge Border", "Filmstrip Border"])
+def test_border_text_reaches_the_border(border):
+    def render(text):
+        processor = ImageProcessor(photo())
+        processor.apply_pipeline("h", "Original", (200, 150), border, cache=RenderCache(0), border_text=text)
+        return np.asarray(processor.image)
+    assert not np.array_equal(render("Hello"), render(None))
+
+
+def test_borders_without_text_ignore_it():
+    steps = ImageProcessor(photo()).plan("Original", (200, 150), "Pixel Frame", seed=1, border_text="Hello").steps
+    assert steps[-1] == ("border", "Pixel Frame", 1, None)
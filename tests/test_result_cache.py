@@ -0,0 +1,51 @@
+import random
+
+from ResultCache import ResultCache
+
+
+def test_near_duplicate_phash_hits_and_distant_one_misses():
+    cache = ResultCache(":memory:")
+    rng = random.Random(3)
+    for i in range(500):
+        cache.put_tags(f"other{i}", [f"tag{i}"], rng.getrandbits(64))
+    phash = rng.getrandbits(64)
+    cache.put_tags("photo", ["sunset"], phash)
+
+    # Four flipped bits spread over every band still find it; the content hash is not needed
+    assert cache.get_tags(phash=phash ^ (1 << 3 | 1 << 20 | 1 << 40 | 1 << 63)) == ["sunset"]
+    assert cache.get_tags(phash=phash ^ 0b11111) is None
+
+
+def test_replaced_and_trimmed_rows_leave_no_bands():
+    cache = ResultCache(":memory:", max_entries=2)
+
+    def bands(key):
+        return cache._db.execute("SELECT COUNT(*) FROM tag_bands WHERE key = ?", (key,)).fetchone()[0]
+    cache.put_tags("a", ["one"], 0)
+    cache.put_tags("a", ["two"], (1 << 64) - 1)
+    assert bands("a") == 5
+    assert cache.get_tags(phash=(1 << 64) - 1) == ["two"]
+    assert cache.get_tags(phash=0) is None
+
+    cache.put_tags("b", ["b"], 2)
+    cache.put_tags("c", ["c"], 3)
+    assert bands("a") == 0
+
+
+def test_hits_are_written_in_batches(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = ResultCache(path)
+    cache.put_text("a prompt", "text")
+    before = ResultCache(path)._db.execute("SELECT last_used FROM texts").fetchone()[0]
+
+    assert cache.get_text("A  prompt") == "text"
+    assert ResultCache(path)._db.execute("SELECT last_used FROM texts").fetchone()[0] == before
+    cache.flush()
+    assert ResultCache(path)._db.execute("SELECT last_used FROM texts").fetchone()[0] > before
+
+
+def test_existing_rows_are_indexed_on_open(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    ResultCache(path).put_tags("photo", ["sunset"], 12345)
+    # Reopened with another distance, the rows get a band layout of its own
+    assert ResultCache(path, phash_distance=2).get_tags(phash=12345 ^ 0b101) == ["sunset"]
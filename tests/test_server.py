@@ -0,0 +1,84 @@
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import server
+
+
+async def send_post(application, body=b"", query=""):
+    """(status, JSON body) of one POST /render, sent straight through the ASGI app."""
+    scope = {'type': 'http', 'method': 'POST', 'path': '/render', 'raw_path': b'/render', 'root_path': '',
+             'query_string': query.encode(), 'headers': [(b'content-length', str(len(body)).encode())],
+             'scheme': 'http', 'server': ('test', 80), 'client': ('127.0.0.1', 1234), 'http_version': '1.1',
+             'app': application}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await application(scope, receive, send)
+    start = next(message for message in messages if message['type'] == 'http.response.start')
+    content = b''.join(message.get('body', b'') for message in messages if message['type'] == 'http.response.body')
+    return start['status'], json.loads(content)
+
+
+def post(application, body=b"", query=""):
+    return asyncio.run(send_post(application, body, query))
+
+
+def render_app(max_pending=4):
+    # No lifespan: none of these requests get as far as the worker pools
+    application = server.create_app(workers=1, max_pending=max_pending)
+    application.state.workers, application.state.max_pending, application.state.pending = 1, max_pending, 0
+    application.state.releasing = set()
+    return application
+
+
+def test_bad_colours_are_rejected_before_rendering():
+    for query in ("font_color=notacolor&text=x", "bg_color=%23zzzzzz&text=x"):
+        status, body = post(render_app(), b"image bytes", query)
+        assert status == 400
+        assert "must be a colour" in body['error']
+
+
+def test_requests_past_max_pending_are_shed():
+    application = render_app(max_pending=2)
+    application.state.pending = 2
+    status, body = post(application, b"image bytes", "text=x")
+    assert status == 503
+    assert application.state.pending == 2
+
+
+def test_oversized_and_empty_uploads_are_rejected(monkeypatch):
+    monkeypatch.setattr(server, 'MAX_UPLOAD_BYTES', 8)
+    application = render_app()
+    assert post(application, b"more than eight bytes", "text=x")[0] == 413
+    assert post(application, b"", "text=x")[0] == 400
+    assert application.state.pending == 0
+
+
+def test_timed_out_render_holds_its_slot_until_the_worker_finishes(monkeypatch):
+    unblock = threading.Event()
+    monkeypatch.setattr(server, 'render_job', lambda *args: unblock.wait())
+    monkeypatch.setattr(server, 'RENDER_TIMEOUT', 0.05)
+    application = render_app(max_pending=1)
+    application.state.cpu_pool = ThreadPoolExecutor(1)
+
+    async def scenario():
+        assert (await send_post(application, b"image bytes", "text=x"))[0] == 504
+        # The worker is still busy with the abandoned render, so nothing new is admitted
+        assert application.state.pending == 1
+        assert (await send_post(application, b"image bytes", "text=x"))[0] == 503
+        unblock.set()
+        await asyncio.gather(*application.state.releasing)
+        assert application.state.pending == 0
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        unblock.set()
+        application.state.cpu_pool.shutdown()
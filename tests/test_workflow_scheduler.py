@@ -0,0 +1,70 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from clarifai_grpc.grpc.api import resources_pb2, service_pb2
+from clarifai_grpc.grpc.api.status import status_code_pb2
+
+from WorkflowScheduler import WorkflowScheduler
+
+
+def tag_request(*images):
+    return service_pb2.PostWorkflowResultsRequest(workflow_id="tag", inputs=[
+        resources_pb2.Input(data=resources_pb2.Data(image=resources_pb2.Image(base64=image))) for image in images
+    ])
+
+
+def scheduler():
+    # A long batch window, so requests submitted together always share one call
+    return WorkflowScheduler(rate=0, batched_workflows={"tag"}, batch_window=0.2)
+
+
+def test_identical_inputs_in_flight_are_sent_once(fake_clarifai):
+    servicer, client = fake_clarifai
+    servicer.latency = 0.1
+    workflows = scheduler()
+    with ThreadPoolExecutor(8) as pool:
+        responses = list(pool.map(lambda session: workflows.submit(client, tag_request(b"viral"), session=session),
+                                  range(8)))
+
+    assert servicer.calls == 1
+    assert all(response.status.code == status_code_pb2.SUCCESS for response in responses)
+    assert all(len(response.results) == 1 for response in responses)
+    assert workflows.stats()["tag"]["coalesced"] == 7
+
+
+def test_distinct_inputs_are_batched_into_one_request(fake_clarifai):
+    servicer, client = fake_clarifai
+    workflows = scheduler()
+    with ThreadPoolExecutor(4) as pool:
+        responses = list(pool.map(lambda i: workflows.submit(client, tag_request(b"photo %d" % i), session=i),
+                                  range(4)))
+
+    assert servicer.calls == 1
+    assert [response.results[0].input.data.image.base64 for response in responses] == [b"photo %d" % i
+                                                                                        for i in range(4)]
+
+
+def test_mixed_status_fails_only_the_bad_input(fake_clarifai):
+    servicer, client = fake_clarifai
+    servicer.bad_images = {b"corrupt"}
+    workflows = scheduler()
+    with ThreadPoolExecutor(2) as pool:
+        good = pool.submit(workflows.submit, client, tag_request(b"fine"), session="alice")
+        bad = pool.submit(workflows.submit, client, tag_request(b"corrupt"), session="bob")
+        good, bad = good.result(), bad.result()
+
+    assert servicer.calls == 1
+    assert good.status.code == status_code_pb2.SUCCESS
+    assert [concept.name for concept in good.results[0].outputs[0].data.concepts] == list(servicer.concepts)
+    assert bad.status.code == status_code_pb2.INPUT_DOWNLOAD_FAILED
+    assert bad.results[0].status.code == status_code_pb2.INPUT_DOWNLOAD_FAILED
+
+
+def test_one_bad_input_in_a_request_keeps_the_others(fake_clarifai):
+    servicer, client = fake_clarifai
+    servicer.bad_images = {b"corrupt"}
+    response = scheduler().submit(client, tag_request(b"fine", b"corrupt", b"also fine"))
+
+    assert response.status.code == status_code_pb2.MIXED_STATUS
+    assert [result.status.code for result in response.results] == [
+        status_code_pb2.SUCCESS, status_code_pb2.INPUT_DOWNLOAD_FAILED, status_code_pb2.SUCCESS]
+    assert response.results[2].outputs[0].data.concepts